@@ -1,13 +1,18 @@
 import datetime
+import functools
 import threading
 
 import colorlog
 import pyufw as ufw
 from flask import Flask, jsonify, request
 
+from functions.auth import api_auth
 from functions.aws import Aws
+from functions.health import health_checker
 from functions.main import ConfigLoader
 from functions.service import ServiceManager
+from functions.standby import standby_pool
+from functions.supervisor import supervisor
 from functions.task_manager import TaskManager
 
 base_socks5_port = 50000
@@ -43,11 +48,59 @@ service = ServiceManager("")
 service.reset_all()
 
 
-def check_task_status(kwargs):
-    config_name = kwargs.get("config_name")
-    if task.profile.get(config_name) is None:
-        task.register_profile(config_name)
-    return task.profile[config_name]["status"]
+def prewarm_images():
+    # public images are the same for every account, one profile is enough
+    for aws_config in app_config.all_aws_configs:
+        try:
+            Aws(aws_config["configName"]).prewarm_images()
+            return
+        except Exception as e:
+            logger.warning(f"Image prewarm failed on {aws_config['configName']}: {e}")
+
+
+def replenish_address_pools():
+    for aws_config in app_config.all_aws_configs:
+        if aws_config["eipPool"] <= 0:
+            continue
+        try:
+            aws = Aws(aws_config["configName"])
+            aws.login()
+            aws.replenish_address_pool()
+        except Exception as e:
+            logger.warning(
+                f"Address pool replenish failed on {aws_config['configName']}: {e}"
+            )
+
+
+if app_config.api_config.get("prewarmImages"):
+    threading.Thread(target=prewarm_images, daemon=True).start()
+threading.Thread(target=replenish_address_pools, daemon=True).start()
+standby_pool.start()
+health_checker.start()
+supervisor.start(task)
+
+
+def require_apikey(profile=True, global_only=False):
+    # global or profile apikey, see ApiAuth.check
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            error = api_auth.check(
+                request.args.get("apikey"),
+                request.args.get("config_name"),
+                profile=profile,
+                global_only=global_only,
+                remote_addr=request.remote_addr,
+            )
+            if error == "Rate limit exceeded":
+                return jsonify({"message": error}), 429
+            if error:
+                return jsonify({"message": error})
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 def check_last_task(kwargs):
@@ -78,19 +131,12 @@ def check_last_task(kwargs):
 
 
 @app.route("/change_ip", methods=["GET"])
+@require_apikey()
 def get_start_process():
-    apikey = request.args.get("apikey")
     config_name = request.args.get("config_name")
     config = ConfigLoader()
-    if config.load_aws_config(config_name) is None:
-        return jsonify({"message": "Config not found"})
     api_config = config.load_api_config()
     aws_config = config.load_aws_config(config_name)
-    config_apikey = api_config.get("apikey")
-    aws_apikey = aws_config.get("apikey")
-    if apikey != config_apikey:
-        if apikey != aws_apikey:
-            return jsonify({"message": "Invalid API key"})
     user = aws_config.get("user")
     password = aws_config.get("pass")
     publicip = api_config.get("publicip")
@@ -125,32 +171,27 @@ def get_start_process():
     except Exception as e:
         response["status"] = "failed"
         response["message"] = str(e)
-        task.set_stop_task(config_name, "failed", response["message"])
+        task.set_stop_task(
+            config_name, "failed", response["message"], task_type=kwargs["task_type"]
+        )
         return jsonify(response)
-    if check_task_status(kwargs) == "busy":
+    ticket = task.submit(kwargs, exclusive=True)
+    if ticket is None:
         response["status"] = "busy"
         response["message"] = "Process is busy"
         return jsonify(response)
-    threading.Thread(target=task.set_start_task, kwargs=kwargs).start()
+    response.update(ticket)
     response["status"] = "busy"
     response["message"] = "Process started"
     return jsonify(response)
 
 
 @app.route("/reset", methods=["GET"])
+@require_apikey()
 def get_reset():
-    apikey = request.args.get("apikey")
     config_name = request.args.get("config_name")
     config = ConfigLoader()
-    if config.load_aws_config(config_name) is None:
-        return jsonify({"message": "Config not found"})
-    api_config = config.load_api_config()
     aws_config = config.load_aws_config(config_name)
-    config_apikey = api_config.get("apikey")
-    aws_apikey = aws_config.get("apikey")
-    if apikey != config_apikey:
-        if apikey != aws_apikey:
-            return jsonify({"message": "Invalid API key"})
     task_type = "reset"
     kwargs = {"task_type": task_type, "config_name": config_name}
     response = {
@@ -163,31 +204,25 @@ def get_reset():
     except Exception as e:
         response["status"] = "failed"
         response["message"] = str(e)
-        task.set_stop_task(config_name, "failed", response["message"])
+        task.set_stop_task(
+            config_name, "failed", response["message"], task_type=kwargs["task_type"]
+        )
         return jsonify(response)
     try:
-        threading.Thread(target=task.set_start_task, kwargs=kwargs).start()
-        return jsonify({"message": "Process started"})
+        ticket = task.submit(kwargs)
+        return jsonify({"message": "Process started", **ticket})
     except Exception as e:
         return jsonify({"message": str(e)})
 
 
 @app.route("/change_auth", methods=["GET"])
+@require_apikey()
 def get_change_auth():
-    apikey = request.args.get("apikey")
     config_name = request.args.get("config_name")
     new_user = request.args.get("new_user")
     new_pass = request.args.get("new_pass")
     config = ConfigLoader()
-    if config.load_aws_config(config_name) is None:
-        return jsonify({"message": "Config not found"})
-    api_config = config.load_api_config()
     aws_config = config.load_aws_config(config_name)
-    config_apikey = api_config.get("apikey")
-    aws_apikey = aws_config.get("apikey")
-    if apikey != config_apikey:
-        if apikey != aws_apikey:
-            return jsonify({"message": "Invalid API key"})
     kwargs = {
         "task_type": "change_auth",
         "config_name": config_name,
@@ -204,34 +239,28 @@ def get_change_auth():
     except Exception as e:
         response["status"] = "failed"
         response["message"] = str(e)
-        task.set_stop_task(config_name, "failed", response["message"])
+        task.set_stop_task(
+            config_name, "failed", response["message"], task_type=kwargs["task_type"]
+        )
         return jsonify(response)
     try:
-        threading.Thread(target=task.set_start_task, kwargs=kwargs).start()
-        return jsonify({"message": "Process started"})
+        ticket = task.submit(kwargs)
+        return jsonify({"message": "Process started", **ticket})
     except Exception as e:
         return jsonify({"message": str(e)})
 
 
 @app.route("/change_region", methods=["GET"])
+@require_apikey()
 def get_change_region():
     # base_socks5_port = 50000
-    apikey = request.args.get("apikey")
     new_region = request.args.get("new_region")
     if new_region is None:
         return jsonify({"message": "New region is not provided"})
     config_name = request.args.get("config_name")
     config = ConfigLoader()
-    if config.load_aws_config(config_name) is None:
-        return jsonify({"message": "Config not found"})
-    api_config = config.load_api_config()
     aws_config = config.load_aws_config(config_name)
     old_region = aws_config.get("region")
-    config_apikey = api_config.get("apikey")
-    aws_apikey = aws_config.get("apikey")
-    if apikey != config_apikey:
-        if apikey != aws_apikey:
-            return jsonify({"message": "Invalid API key"})
     task_type = "change_region"
     new_region = request.args.get("new_region")
     kwargs = {
@@ -251,7 +280,9 @@ def get_change_region():
     except Exception as e:
         response["status"] = "failed"
         response["message"] = str(e)
-        task.set_stop_task(config_name, "failed", response["message"])
+        task.set_stop_task(
+            config_name, "failed", response["message"], task_type=kwargs["task_type"]
+        )
         return jsonify(response)
     if hasattr(task.profile[config_name], "current_task"):
         response["current_task"] = task.profile[config_name]["current_task"]
@@ -259,28 +290,21 @@ def get_change_region():
     if old_region == new_region:
         response["message"] = "New region is the same as the old region"
         return jsonify(response)
-    if check_task_status(kwargs) == "busy":
+    ticket = task.submit(kwargs, exclusive=True)
+    if ticket is None:
         response["message"] = "Process is busy"
         return jsonify(response)
-    threading.Thread(target=task.set_start_task, kwargs=kwargs).start()
+    response.update(ticket)
     response["message"] = "Process started"
     return jsonify(response)
 
 
 @app.route("/get_available_region", methods=["GET"])
+@require_apikey()
 def get_available_region():
-    apikey = request.args.get("apikey")
     config_name = request.args.get("config_name")
     config = ConfigLoader()
-    if config.load_aws_config(config_name) is None:
-        return jsonify({"message": "Config not found"})
-    api_config = config.load_api_config()
     aws_config = config.load_aws_config(config_name)
-    config_apikey = api_config.get("apikey")
-    aws_apikey = aws_config.get("apikey")
-    if apikey != config_apikey:
-        if apikey != aws_apikey:
-            return jsonify({"message": "Invalid API key"})
     response = {
         "config_name": config_name,
         "region": aws_config.get("region"),
@@ -291,27 +315,47 @@ def get_available_region():
     except Exception as e:
         response["status"] = "failed"
         response["message"] = str(e)
-        task.set_stop_task(config_name, "failed", response["message"])
+        task.set_stop_task(
+            config_name, "failed", response["message"], task_type="get_available_region"
+        )
         return jsonify(response)
-    regions = aws.get_all_regions()
+    regions = aws.get_available_regions()
     return jsonify(regions)
 
 
+@app.route("/get_instance_types", methods=["GET"])
+@require_apikey()
+def get_instance_types():
+    config_name = request.args.get("config_name")
+    refresh = request.args.get("refresh") == "true"
+    config = ConfigLoader()
+    aws_config = config.load_aws_config(config_name)
+    region = request.args.get("region") or aws_config.get("region")
+    response = {
+        "config_name": config_name,
+        "region": region,
+    }
+    aws = Aws(config_name)
+    try:
+        aws.login()
+        response["instance_types"] = aws.get_instance_type_catalogue(
+            region, refresh=refresh
+        )
+    except Exception as e:
+        response["status"] = "failed"
+        response["message"] = str(e)
+        return jsonify(response)
+    return jsonify(response)
+
+
 @app.route("/get_config", methods=["GET"])
+@require_apikey()
 def get_config_detail():
-    apikey = request.args.get("apikey")
     config_name = request.args.get("config_name")
     config = ConfigLoader()
-    if config.load_aws_config(config_name) is None:
-        return jsonify({"message": "Config not found"})
     api_config = config.load_api_config()
     publicip = api_config.get("publicip")
     aws_config = config.load_aws_config(config_name)
-    config_apikey = api_config.get("apikey")
-    aws_apikey = aws_config.get("apikey")
-    if apikey != config_apikey:
-        if apikey != aws_apikey:
-            return jsonify({"message": "Invalid API key"})
     response = {
         "config_name": config_name,
         "region": aws_config.get("region"),
@@ -322,9 +366,11 @@ def get_config_detail():
     except Exception as e:
         response["status"] = "failed"
         response["message"] = str(e)
-        task.set_stop_task(config_name, "failed", response["message"])
+        task.set_stop_task(
+            config_name, "failed", response["message"], task_type="get_config"
+        )
         return jsonify(response)
-    response["available_region"] = aws.get_all_regions()
+    response["available_region"] = aws.get_available_regions()
     profile_task = task.profile.get(config_name)
     current_task = profile_task.get("current_task") or None
     last_task = profile_task.get("last_task") or None
@@ -356,43 +402,114 @@ def get_config_detail():
 
 
 @app.route("/change_whitelist", methods=["GET"])
+@require_apikey()
 def change_whitelist():
-    apikey = request.args.get("apikey")
     config_name = request.args.get("config_name")
     new_whitelist = request.args.get("new_whitelist")
-    config = ConfigLoader()
-    if config.load_aws_config(config_name) is None:
-        return jsonify({"message": "Config not found"})
-    api_config = config.load_api_config()
-    aws_config = config.load_aws_config(config_name)
-    config_apikey = api_config.get("apikey")
-    aws_apikey = aws_config.get("apikey")
     kwargs = {
         "task_type": "change_whitelist",
         "config_name": config_name,
         "new_whitelist": new_whitelist,
     }
-    if apikey != config_apikey:
-        if apikey != aws_apikey:
-            return jsonify({"message": "Invalid API key"})
     try:
-        threading.Thread(target=task.set_start_task, kwargs=kwargs).start()
-        return jsonify({"message": "Process started"})
+        ticket = task.submit(kwargs)
+        return jsonify({"message": "Process started", **ticket})
     except Exception as e:
         return jsonify({"message": str(e)})
 
 
+@app.route("/bake_image", methods=["GET"])
+@require_apikey()
+def bake_image():
+    config_name = request.args.get("config_name")
+    regions = request.args.get("regions")
+    kwargs = {
+        "task_type": "bake_image",
+        "config_name": config_name,
+        "regions": regions,
+    }
+    ticket = task.submit(kwargs, exclusive=True)
+    if ticket is None:
+        return jsonify({"message": "Process is busy"})
+    return jsonify({"message": "Process started", **ticket})
+
+
+@app.route("/refresh_bundle", methods=["GET"])
+@require_apikey(global_only=True)
+def refresh_bundle():
+    config_name = request.args.get("config_name")
+    kwargs = {"task_type": "refresh_bundle", "config_name": config_name}
+    ticket = task.submit(kwargs, exclusive=True)
+    if ticket is None:
+        return jsonify({"message": "Process is busy"})
+    return jsonify({"message": "Process started", **ticket})
+
+
+@app.route("/get_standby", methods=["GET"])
+@require_apikey()
+def get_standby():
+    config_name = request.args.get("config_name")
+    config = ConfigLoader()
+    aws_config = config.load_aws_config(config_name)
+    response = {
+        "config_name": config_name,
+        "region": aws_config.get("region"),
+        "standby_regions": aws_config.get("standbyRegions"),
+        "standby_state": aws_config.get("standbyState"),
+        "standby": standby_pool.get_state(config_name),
+    }
+    return jsonify(response)
+
+
+@app.route("/health", methods=["GET"])
+@require_apikey(profile=False)
+def get_health():
+    config_name = request.args.get("config_name")
+    return jsonify(health_checker.get_snapshot(config_name))
+
+
+@app.route("/get_heal", methods=["GET"])
+@require_apikey(profile=False)
+def get_heal():
+    config_name = request.args.get("config_name")
+    return jsonify(supervisor.get_state(config_name))
+
+
+@app.route("/echo_ip", methods=["GET"])
+def echo_ip():
+    # egress check target for egresscheckurl, answers with the caller address
+    return request.remote_addr
+
+
 @app.route("/get_task", methods=["GET"])
+@require_apikey(profile=False, global_only=True)
 def get_task():
-    apikey = request.args.get("apikey")
-    config = ConfigLoader()
-    api_config = config.load_api_config()
-    config_apikey = api_config.get("apikey")
-    if apikey != config_apikey:
-        return jsonify({"message": "Invalid API key"})
+    task_id = request.args.get("task_id")
+    if task_id:
+        return jsonify(task.get_task(task_id) or {"message": "Task not found"})
+    config_name = request.args.get("config_name")
+    if config_name:
+        return jsonify(task.profile.get(config_name) or {})
     return jsonify(task.profile)
 
 
+@app.route("/get_task_history", methods=["GET"])
+@require_apikey(profile=False)
+def get_task_history():
+    config_name = request.args.get("config_name")
+    try:
+        history = task.get_history(
+            config_name=config_name,
+            since=request.args.get("since"),
+            until=request.args.get("until"),
+            status=request.args.get("status"),
+            limit=max(1, min(int(request.args.get("limit", 100)), 1000)),
+        )
+    except ValueError:
+        return jsonify({"message": "Invalid limit"})
+    return jsonify({"config_name": config_name, "tasks": history})
+
+
 if __name__ == "__main__":
     ufw.enable()
     ufw.default(incoming="allow", outgoing="allow", routed="allow")
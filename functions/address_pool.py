@@ -0,0 +1,216 @@
+import queue
+import threading
+
+import colorlog
+
+logger = colorlog.getLogger()
+
+pool_tag = {"Key": "role", "Value": "iprotate-pool"}
+eip_quota_code = "L-0263D0A3"
+default_eip_quota = 5
+
+
+class AddressPool:
+    """Pre-allocated, unassociated Elastic IPs per account and region.
+
+    take() hands out an address from memory so a rotation only needs an
+    associate_address call; replenish() tops the pool back up in the
+    background without exceeding the account's Elastic IP quota.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.quotas = {}
+        self.replenishing = set()
+        # handed out but maybe still tagged as pooled in a stale listing
+        self.taken = {}
+
+    def list_pool(self, ec2):
+        response = ec2.describe_addresses(
+            Filters=[{"Name": f"tag:{pool_tag['Key']}", "Values": [pool_tag["Value"]]}]
+        )
+        return [
+            {"AllocationId": address["AllocationId"], "PublicIp": address["PublicIp"]}
+            for address in response["Addresses"]
+            if "AssociationId" not in address
+        ]
+
+    def get_quota(self, quotas_client, key):
+        if key in self.quotas:
+            return self.quotas[key]
+        try:
+            response = quotas_client.get_service_quota(
+                ServiceCode="ec2", QuotaCode=eip_quota_code
+            )
+            quota = int(response["Quota"]["Value"])
+        except Exception as e:
+            logger.warning(f"Using default Elastic IP quota for {key[1]}: {e}")
+            quota = default_eip_quota
+        self.quotas[key] = quota
+        return quota
+
+    def merge(self, key, listed):
+        # called with the lock held, a listing may predate take() calls
+        listed_ids = {address["AllocationId"] for address in listed}
+        taken = self.taken.get(key, set()) & listed_ids
+        self.taken[key] = taken
+        known = [
+            address
+            for address in self.pools.get(key, [])
+            if address["AllocationId"] in listed_ids
+        ]
+        known_ids = {address["AllocationId"] for address in known}
+        self.pools[key] = known + [
+            address
+            for address in listed
+            if address["AllocationId"] not in known_ids | taken
+        ]
+
+    def take(self, ec2, key):
+        with self.lock:
+            known = bool(self.pools.get(key))
+        if not known:
+            # nothing known in memory, pick up addresses left from a previous run
+            listed = self.list_pool(ec2)
+            with self.lock:
+                self.merge(key, listed)
+        with self.lock:
+            pool = self.pools.get(key)
+            if not pool:
+                return None
+            address = pool.pop(0)
+            self.taken.setdefault(key, set()).add(address["AllocationId"])
+            return address
+
+    def untake(self, key, allocation_id):
+        # the claim failed and the address is tagged as pooled again
+        with self.lock:
+            self.taken.get(key, set()).discard(allocation_id)
+
+    def replenish(self, ec2, quotas_client, key, size):
+        pool = self.list_pool(ec2)
+        in_use = len(ec2.describe_addresses()["Addresses"])
+        # keep one address of headroom for the non pooled rotation path
+        free_quota = self.get_quota(quotas_client, key) - in_use - 1
+        missing = min(size - len(pool), free_quota)
+        for _ in range(max(missing, 0)):
+            response = ec2.allocate_address(
+                Domain="vpc",
+                TagSpecifications=[{"ResourceType": "elastic-ip", "Tags": [pool_tag]}],
+            )
+            pool.append(
+                {
+                    "AllocationId": response["AllocationId"],
+                    "PublicIp": response["PublicIp"],
+                }
+            )
+        with self.lock:
+            self.merge(key, pool)
+            pool = list(self.pools[key])
+        if missing > 0:
+            logger.info(f"Allocated {missing} pooled addresses in {key[1]}")
+        return pool
+
+    def replenish_async(self, ec2, quotas_client, key, size):
+        with self.lock:
+            if size <= 0 or key in self.replenishing:
+                return
+            self.replenishing.add(key)
+
+        def run():
+            try:
+                self.replenish(ec2, quotas_client, key, size)
+            except Exception as e:
+                logger.warning(f"Failed to replenish address pool in {key[1]}: {e}")
+            finally:
+                with self.lock:
+                    self.replenishing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+address_pool = AddressPool()
+
+
+class ReleaseQueue:
+    """Releases replaced Elastic IPs off the rotation path.
+
+    Jobs release every address tagged for an instance except the one it has
+    when the job runs, so a retry never takes the address of a newer rotation;
+    failures are retried with exponential backoff and only logged so a stuck
+    release never fails the task that queued it.
+    """
+
+    def __init__(self, max_attempts=5, backoff=2):
+        self.jobs = queue.Queue()
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.instance_locks = {}
+        self.worker = None
+
+    def instance_lock(self, instance_id):
+        # held while an address is moved onto the instance, a release never
+        # sees an allocated address before it is associated
+        with self.lock:
+            return self.instance_locks.setdefault(instance_id, threading.RLock())
+
+    def put(self, ec2, instance_id, exclude, attempt=1):
+        self.start()
+        self.jobs.put(
+            {
+                "ec2": ec2,
+                "instance_id": instance_id,
+                "exclude": exclude,
+                "attempt": attempt,
+            }
+        )
+
+    def start(self):
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def release(self, ec2, instance_id, exclude=None, keep_current=True):
+        response = ec2.describe_addresses(
+            Filters=[{"Name": "tag:instance", "Values": [instance_id]}]
+        )
+        for address in response["Addresses"]:
+            if address["AllocationId"] == exclude:
+                continue
+            if keep_current and address.get("InstanceId") == instance_id:
+                # live address, maybe from a rotation newer than this job
+                continue
+            if "AssociationId" in address:
+                ec2.disassociate_address(AssociationId=address["AssociationId"])
+            ec2.release_address(AllocationId=address["AllocationId"])
+            logger.info(f"Released {address['PublicIp']} from {instance_id}")
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                with self.instance_lock(job["instance_id"]):
+                    self.release(job["ec2"], job["instance_id"], job["exclude"])
+            except Exception as e:
+                if job["attempt"] >= self.max_attempts:
+                    logger.error(
+                        f"Giving up releasing addresses of {job['instance_id']}: {e}"
+                    )
+                    continue
+                delay = self.backoff ** job["attempt"]
+                logger.warning(
+                    f"Release for {job['instance_id']} failed, retrying in {delay}s: {e}"
+                )
+                threading.Timer(
+                    delay,
+                    self.put,
+                    args=(job["ec2"], job["instance_id"], job["exclude"]),
+                    kwargs={"attempt": job["attempt"] + 1},
+                ).start()
+
+
+release_queue = ReleaseQueue()
@@ -0,0 +1,111 @@
+import hmac
+import threading
+import time
+
+import colorlog
+
+from functions.main import config_snapshot
+
+logger = colorlog.getLogger()
+
+
+class ApiAuth:
+    """API key checks against an index built once per config.conf version.
+
+    The global key and every profile key are read from the shared config
+    snapshot and only re-indexed when the file changes. Keys are compared in
+    constant time and each accepted key draws from its own token bucket of
+    `ratelimitburst` requests, refilled at `ratelimit` requests per second.
+    Rejected attempts draw from a bucket per client address instead, so keys
+    cannot be guessed at full speed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.source = None
+        self.global_key = b""
+        self.profile_keys = {}
+        self.rate = 0.0
+        self.burst = 0.0
+        self.buckets = {}
+
+    def index(self):
+        data = config_snapshot.get()
+        if data is self.source:
+            return
+        with self.lock:
+            if data is self.source:
+                return
+            api = data.get("api", {})
+            self.global_key = (api.get("apikey") or "").encode()
+            self.profile_keys = {
+                section: (values.get("apikey") or "").encode()
+                for section, values in data.items()
+                if section != "api"
+            }
+            self.rate = float(api.get("ratelimit", "5"))
+            self.burst = float(api.get("ratelimitburst", "20"))
+            # a config change must not refill everyone, only forget keys
+            # that are gone
+            keys = {self.global_key, *self.profile_keys.values()}
+            self.buckets = {
+                bucket: state
+                for bucket, state in self.buckets.items()
+                if not isinstance(bucket, bytes) or bucket in keys
+            }
+            self.source = data
+
+    def authenticate(self, apikey, config_name=None, global_only=False):
+        if not apikey:
+            return False
+        apikey = apikey.encode()
+        if self.global_key and hmac.compare_digest(apikey, self.global_key):
+            return True
+        if global_only:
+            return False
+        profile_key = self.profile_keys.get(config_name)
+        return bool(profile_key) and hmac.compare_digest(apikey, profile_key)
+
+    def take_token(self, bucket):
+        # bucket is the accepted key as bytes or the client address as str
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(bucket, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[bucket] = (tokens, now)
+                return False
+            self.buckets[bucket] = (tokens - 1, now)
+            return True
+
+    def check(
+        self,
+        apikey,
+        config_name=None,
+        profile=True,
+        global_only=False,
+        remote_addr=None,
+    ):
+        """Return None when the request may proceed, otherwise the reason.
+
+        profile=True requires config_name to name an existing profile.
+        """
+        self.index()
+        if profile and config_name not in self.profile_keys:
+            return "Config not found"
+        if not self.authenticate(apikey, config_name, global_only):
+            if not self.take_token(remote_addr or "unknown"):
+                logger.warning(
+                    f"Rate limit exceeded for failed attempts from {remote_addr}"
+                )
+                return "Rate limit exceeded"
+            return "Invalid API key"
+        if not self.take_token(apikey.encode()):
+            logger.warning(f"Rate limit exceeded for key of {config_name or 'api'}")
+            return "Rate limit exceeded"
+        return None
+
+
+api_auth = ApiAuth()
@@ -1,23 +1,149 @@
 import binascii
+import datetime
 import hashlib
+import threading
+import time
 
 import ansible_runner  # noqa: F401
-import boto3
 import colorlog
 import paramiko
+import yaml
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 
+from .address_pool import address_pool, pool_tag, release_queue
+from .cache import DiskCache
+from .client_pool import client_pool
 from .main import ConfigLoader
 
 logger = colorlog.getLogger()
 
+change_eth_script_path = "/opt/cloud-iprotate/change_eth.sh"
+image_name = "ubuntu/images/hvm-ssd-gp3/ubuntu-noble-24.04-amd64-server-20250305"
+image_cache = DiskCache("images", ttl=7 * 24 * 3600)
+instance_type_cache = DiskCache("instance_types", ttl=7 * 24 * 3600)
+
+
+class LoginCache:
+    """TTL cache of credential checks so callers skip describe_regions.
+
+    Successful checks are kept for loginCacheTtl seconds and refreshed in the
+    background before they expire, failures are kept for loginFailureTtl
+    seconds so a broken account is not retried on every request. The region
+    list is kept in the same entry once it was asked for.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.refresher = None
+        self.refresh_interval = 30
+
+    def cache_key(self, aws):
+        return (aws.config_name, aws.aws_config["accessKey"], aws.aws_config["region"])
+
+    def ttl(self, aws, valid):
+        if valid:
+            return int(aws.config.api_config["loginCacheTtl"])
+        return int(aws.config.api_config["loginFailureTtl"])
+
+    def check(self, aws):
+        key = self.cache_key(aws)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or time.time() - entry["checked"] > self.ttl(
+            aws, entry["valid"]
+        ):
+            entry = self.refresh(aws)
+        self.start_refresher()
+        if not entry["valid"]:
+            raise Exception(entry["error"])
+        return True
+
+    def refresh(self, aws):
+        with self.lock:
+            previous = self.entries.get(self.cache_key(aws)) or {}
+        try:
+            aws.verify_login()
+            entry = {"valid": True, "error": None, "checked": time.time()}
+            if previous.get("regions") is not None:
+                entry["regions"] = aws.get_all_regions()
+        except Exception as e:
+            entry = {"valid": False, "error": str(e), "checked": time.time()}
+        with self.lock:
+            self.entries[self.cache_key(aws)] = entry
+        return entry
+
+    def regions(self, aws):
+        self.check(aws)
+        key = self.cache_key(aws)
+        with self.lock:
+            regions = (self.entries.get(key) or {}).get("regions")
+        if regions is None:
+            regions = aws.get_all_regions()
+            with self.lock:
+                if key in self.entries:
+                    self.entries[key]["regions"] = regions
+        return regions
+
+    def invalidate(self, config_name):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == config_name]:
+                self.entries.pop(key, None)
+
+    def discard_key(self, access_key, config):
+        # other profiles may share the key, keep its clients while in use
+        if any(
+            aws_config.get("accessKey") == access_key
+            for aws_config in config.all_aws_configs
+        ):
+            return
+        client_pool.discard(access_key)
+        logger.info(f"Dropped clients of rotated access key {access_key}")
+
+    def start_refresher(self):
+        with self.lock:
+            if self.refresher is not None:
+                return
+            self.refresher = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.refresher.start()
+
+    def refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            with self.lock:
+                entries = list(self.entries.items())
+            for key, entry in entries:
+                try:
+                    # key[2] may be a region override, check the same region
+                    aws = Aws(key[0], region=key[2])
+                    if aws.aws_config["accessKey"] != key[1]:
+                        # credentials were rotated, forget the old key
+                        self.invalidate(key[0])
+                        self.discard_key(key[1], aws.config)
+                        continue
+                    # refresh valid entries at half their ttl so requests
+                    # never wait on describe_regions
+                    age = time.time() - entry["checked"]
+                    if entry["valid"] and age > self.ttl(aws, True) / 2:
+                        self.refresh(aws)
+                except Exception as e:
+                    logger.warning(f"[{key[0]}] Credential refresh failed: {e}")
+                    with self.lock:
+                        self.entries.pop(key, None)
+
+
+login_cache = LoginCache()
+
 
 class Aws:
-    def __init__(self, config_name):
+    def __init__(self, config_name, region=None):
         self.config = ConfigLoader()
         self.config_name = config_name
         self.aws_config = self.config.load_aws_config(config_name)
+        if region:
+            # work in another region without touching the profile config
+            self.aws_config["region"] = region
         self.user_data = """#cloud-config
             network:
             version: 2
@@ -28,6 +154,62 @@ class Aws:
                 set-name: eth0
             """
 
+    def render_user_data(self, peer_config):
+        # bring the whole peer up during boot so no ssh session is needed
+        with open(change_eth_script_path, "r") as file:
+            change_eth_script = file.read()
+        apt_options = "-o DPkg::Lock::Timeout=300"
+        # the .sha256 sidecars let a later ssh setup skip unchanged files
+        cloud_config = {
+            "write_files": [
+                {
+                    "path": "/etc/wireguard/wg0.conf",
+                    "permissions": "0600",
+                    "content": peer_config,
+                },
+                {
+                    "path": "/etc/wireguard/wg0.conf.sha256",
+                    "content": hashlib.sha256(peer_config.encode()).hexdigest() + "\n",
+                },
+                {
+                    "path": "/opt/iprotate/change_eth.sh.sha256",
+                    "content": hashlib.sha256(change_eth_script.encode()).hexdigest()
+                    + "\n",
+                },
+                {
+                    "path": "/etc/sysctl.d/99-sysctl.conf",
+                    "content": "net.ipv4.ip_forward = 1\n",
+                },
+                {
+                    "path": "/opt/iprotate/change_eth.sh",
+                    "permissions": "0755",
+                    "content": change_eth_script,
+                },
+            ],
+            "runcmd": [
+                "command -v wg-quick > /dev/null || "
+                + f"(apt-get {apt_options} update -y && "
+                + f"apt-get {apt_options} install -y wireguard)",
+                "sysctl -p /etc/sysctl.d/99-sysctl.conf",
+                "bash /opt/iprotate/change_eth.sh",
+                "systemctl enable wg-quick@wg0",
+                "systemctl restart wg-quick@wg0",
+                f"apt-get {apt_options} purge -y unattended-upgrades || true",
+            ],
+        }
+        return "#cloud-config\n" + yaml.safe_dump(cloud_config, sort_keys=False)
+
+    def get_client(self, service="ec2", region=None):
+        try:
+            return client_pool.get_client(
+                service,
+                self.aws_config["accessKey"],
+                self.aws_config["secretKey"],
+                region or self.aws_config["region"],
+            )
+        except Exception as awsClientError:
+            raise Exception(f"Error connecting to AWS: {awsClientError}")
+
     def format_fingerprint(self, fingerprint):
         # Convert the byte string to a hexadecimal string
         hex_fingerprint = binascii.hexlify(fingerprint).decode("utf-8")
@@ -37,30 +219,45 @@ class Aws:
         )
         return formatted_fingerprint
 
-    def describe_images(self):
-        try:
-            self.ec2 = boto3.client(
-                "ec2",
-                region_name=self.aws_config["region"],
-                aws_access_key_id=self.aws_config["accessKey"],
-                aws_secret_access_key=self.aws_config["secretKey"],
-            )
-        except Exception as awsClientError:
-            raise Exception(f"Error connecting to AWS: {awsClientError}")
-        response = self.ec2.describe_images(
+    def describe_images(self, region=None):
+        ec2 = self.get_client(region=region)
+        response = ec2.describe_images(
             IncludeDeprecated=True,
             IncludeDisabled=True,
             Filters=[
                 {
                     "Name": "name",
                     "Values": [
-                        "ubuntu/images/hvm-ssd-gp3/ubuntu-noble-24.04-amd64-server-20250305",
+                        image_name,
                     ],
                 },
             ],
         )
         return response
 
+    def get_image_id(self, region=None):
+        region = region or self.aws_config["region"]
+        cached = image_cache.get(region)
+        if cached and cached.get("Name") == image_name:
+            return cached["ImageId"]
+        images = self.describe_images(region).get("Images", [])
+        if not images:
+            raise Exception(f"Image {image_name} not found in {region}")
+        image_id = images[0]["ImageId"]
+        image_cache.set(region, {"ImageId": image_id, "Name": image_name})
+        logger.info(f"Cached image {image_id} for {region}")
+        return image_id
+
+    def prewarm_images(self):
+        for region in self.get_all_regions():
+            region_name = region["RegionName"]
+            if region.get("OptInStatus") == "not-opted-in":
+                continue
+            try:
+                self.get_image_id(region_name)
+            except Exception as e:
+                logger.warning(f"Failed to resolve image for {region_name}: {e}")
+
     def set_keypair(self):
         try:
             private_key = paramiko.RSAKey.from_private_key_file(
@@ -164,7 +361,7 @@ class Aws:
         )
         return self.security_group
 
-    def launch_instance(self):
+    def launch_instance(self, peer_config=None):
         instances_list = self.ec2.describe_instances()
         for instance in instances_list["Reservations"]:
             if hasattr(instance["Instances"][0], "Tags"):
@@ -183,51 +380,142 @@ class Aws:
                         self.config.write_changes(self.config_name)
                         self.aws_config = self.config.load_aws_config(self.config_name)
                         return instance["Instances"][0]
+        new_instance_id = self.run_instance(peer_config=peer_config)
+        self.config.set_value(self.config_name, "instanceId", new_instance_id)
+        self.config.write_changes(self.config_name)
+        self.aws_config = self.config.load_aws_config(self.config_name)
+        self.aws_config["instanceId"] = new_instance_id
+        self.config.set_value(self.config_name, "instanceId", new_instance_id)
+        self.config.write_changes(self.config_name)
+        return self.ec2.describe_instances(InstanceIds=[new_instance_id])
+
+    def run_instance(self, peer_config=None, tags=None):
+        self.ec2 = self.get_client()
         self.create_security_group()
-        instance_type = self.get_instance_type_free_tier().get("InstanceType")  # type: ignore
-        try:
-            self.ec2 = boto3.client(
-                "ec2",
-                region_name=self.aws_config["region"],
-                aws_access_key_id=self.aws_config["accessKey"],
-                aws_secret_access_key=self.aws_config["secretKey"],
-            )
-        except Exception as awsClientError:
-            raise Exception(f"Error connecting to AWS: {awsClientError}")
+        instance_type = self.get_instance_type_free_tier()["InstanceType"]
         self.set_keypair()
-        instance = self.resource.create_instances(  # type: ignore
-            ImageId=self.describe_images().get("Images")[0].get("ImageId"),
-            InstanceType=instance_type,
-            KeyName=self.key_pair_name,
-            UserData=self.user_data,
-            SecurityGroups=[
+        launch_options = {
+            "InstanceType": instance_type,
+            "KeyName": self.key_pair_name,
+            "UserData": (
+                self.render_user_data(peer_config) if peer_config else self.user_data
+            ),
+            "SecurityGroups": [
                 "iprotate",
             ],
-            MaxCount=1,
-            MinCount=1,
-            TagSpecifications=[
+            "MaxCount": 1,
+            "MinCount": 1,
+            "TagSpecifications": [
                 {
                     "ResourceType": "instance",
-                    "Tags": [{"Key": "role", "Value": "iprotate"}],
+                    "Tags": tags or [{"Key": "role", "Value": "iprotate"}],
                 }
             ],
-        )
-        new_instance_id = instance[0].id
+        }
+        golden_image = self.aws_config["goldenImages"].get(self.aws_config["region"])
+        try:
+            response = self.ec2.run_instances(
+                ImageId=golden_image or self.get_image_id(), **launch_options
+            )
+        except Exception as e:
+            if not golden_image or "InvalidAMIID" not in str(e):
+                raise
+            logger.warning(
+                f"[{self.config_name}] Golden image {golden_image} is gone, using stock image"
+            )
+            self.config.set_golden_image(
+                self.config_name, self.aws_config["region"], None
+            )
+            response = self.ec2.run_instances(
+                ImageId=self.get_image_id(), **launch_options
+            )
+        new_instance_id = response["Instances"][0]["InstanceId"]
         waiter = self.ec2.get_waiter("instance_running")
         waiter.wait(InstanceIds=[new_instance_id])
-        self.config.set_value(self.config_name, "instanceId", new_instance_id)
-        self.config.write_changes(self.config_name)
+        return new_instance_id
+
+    def list_standby_instances(self):
+        response = self.ec2.describe_instances(
+            Filters=[
+                {"Name": "tag:role", "Values": ["iprotate-standby"]},
+                {"Name": "tag:profile", "Values": [self.config_name]},
+                {
+                    "Name": "instance-state-name",
+                    "Values": ["pending", "running", "stopping", "stopped"],
+                },
+            ]
+        )
+        return [
+            instance
+            for reservation in response["Reservations"]
+            for instance in reservation["Instances"]
+        ]
+
+    def start_standby_instance(self, instance_id):
+        # claim it first so the standby reconciler leaves it alone
+        self.ec2.create_tags(
+            Resources=[instance_id], Tags=[{"Key": "role", "Value": "iprotate"}]
+        )
+        self.ec2.start_instances(InstanceIds=[instance_id])
+        self.ec2.get_waiter("instance_running").wait(InstanceIds=[instance_id])
+        self.aws_config["instanceId"] = instance_id
+        return instance_id
+
+    def create_golden_image(self, regions=None):
+        date = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        name = f"iprotate-golden-{date}"
+        tags = [
+            {
+                "ResourceType": "image",
+                "Tags": [{"Key": "role", "Value": "iprotate-golden"}],
+            }
+        ]
+        response = self.ec2.create_image(
+            InstanceId=self.aws_config["instanceId"],
+            Name=name,
+            Description="iprotate peer with wireguard preinstalled",
+            NoReboot=True,
+            TagSpecifications=tags,
+        )
+        images = {self.aws_config["region"]: response["ImageId"]}
+        # copies start in parallel, the source image has to be available first
+        waiter_config = {"Delay": 15, "MaxAttempts": 240}
+        self.ec2.get_waiter("image_available").wait(
+            ImageIds=[response["ImageId"]], WaiterConfig=waiter_config
+        )
+        for region in regions or []:
+            if region in images:
+                continue
+            ec2 = self.get_client(region=region)
+            copy = ec2.copy_image(
+                Name=name,
+                SourceImageId=response["ImageId"],
+                SourceRegion=self.aws_config["region"],
+                TagSpecifications=tags,
+            )
+            images[region] = copy["ImageId"]
+        for region, image_id in images.items():
+            self.get_client(region=region).get_waiter("image_available").wait(
+                ImageIds=[image_id], WaiterConfig=waiter_config
+            )
+            self.config.set_golden_image(self.config_name, region, image_id)
+            logger.info(f"[{self.config_name}] Golden image {image_id} in {region}")
         self.aws_config = self.config.load_aws_config(self.config_name)
-        self.aws_config["instanceId"] = new_instance_id
-        self.config.set_value(self.config_name, "instanceId", new_instance_id)
-        self.config.write_changes(self.config_name)
-        return self.ec2.describe_instances(InstanceIds=[new_instance_id])
+        return images
 
-    def terminate_instance(self):
+    def terminate_instance(self, instance_id=None):
+        if instance_id:
+            # a single instance, the profile config is left to the caller
+            self.ec2.terminate_instances(InstanceIds=[instance_id])
+            logger.info(f"[{self.config_name}] Instance {instance_id} terminated")
+            return {"InstanceId": instance_id, "State": "terminated"}
         instances_list = self.ec2.describe_instances()
         if instances_list["Reservations"] is None:
             return
         for instance in instances_list["Reservations"]:
+            tags = instance["Instances"][0].get("Tags", [])
+            if {"Key": "role", "Value": "iprotate-standby"} in tags:
+                continue
             instance_id = instance["Instances"][0]["InstanceId"]
             self.ec2.terminate_instances(InstanceIds=[instance_id])
         self.config.set_value(self.config_name, "instanceId", "")
@@ -236,25 +524,49 @@ class Aws:
         logger.info(f"Instance terminated on {self.aws_config['configName']}")
         return instance_detail
 
+    def get_instance_type_catalogue(self, region=None, refresh=False):
+        region = region or self.aws_config["region"]
+        catalogue = None if refresh else instance_type_cache.get(region)
+        if catalogue is not None:
+            return catalogue
+        ec2 = self.get_client(region=region)
+        paginator = ec2.get_paginator("describe_instance_types")
+        catalogue = []
+        for page in paginator.paginate(
+            Filters=[{"Name": "free-tier-eligible", "Values": ["true"]}],
+            PaginationConfig={"PageSize": 100},
+        ):
+            for instance in page.get("InstanceTypes", []):
+                catalogue.append(
+                    {
+                        "InstanceType": instance["InstanceType"],
+                        "DefaultVCpus": instance["VCpuInfo"]["DefaultVCpus"],
+                        "DefaultCores": instance["VCpuInfo"].get("DefaultCores"),
+                        "MemoryMiB": instance["MemoryInfo"]["SizeInMiB"],
+                        "NetworkPerformance": instance["NetworkInfo"][
+                            "NetworkPerformance"
+                        ],
+                        "Architectures": instance["ProcessorInfo"][
+                            "SupportedArchitectures"
+                        ],
+                    }
+                )
+        if not catalogue:
+            # may be a transient api answer, ask again next time
+            logger.warning(f"No free tier instance types listed in {region}")
+            return catalogue
+        instance_type_cache.set(region, catalogue)
+        logger.info(f"Cached {len(catalogue)} free tier instance types for {region}")
+        return catalogue
+
     def get_instance_type_free_tier(self):
-        instance_list = self.ec2.describe_instance_types(
-            MaxResults=100, Filters=[{"Name": "free-tier-eligible", "Values": ["true"]}]
-        )
-        all_instance_types = instance_list.get("InstanceTypes", [])
-        while "NextToken" in instance_list:
-            next_token = instance_list["NextToken"]
-            if not next_token:
-                break
-            instance_list = self.ec2.describe_instance_types(
-                MaxResults=100,
-                NextToken=next_token,
-                Filters=[{"Name": "free-tier-eligible", "Values": ["true"]}],
-            )
-            all_instance_types.extend(instance_list.get("InstanceTypes", []))
-        for instance in all_instance_types:
-            if instance["VCpuInfo"]["DefaultCores"] == 1:
+        for instance in self.get_instance_type_catalogue():
+            if instance["DefaultCores"] == 1 and "x86_64" in instance["Architectures"]:
                 return instance
-        return None
+        raise Exception(
+            "No free tier x86_64 instance type with 1 core in "
+            + f"{self.aws_config['region']}"
+        )
 
     """ def run_ansible_playbook(self, playbook_path):
         for i in range(10):
@@ -303,25 +615,20 @@ class Aws:
             """
 
     def get_all_regions(self):
-        ec2 = boto3.client(
-            "ec2",
-            region_name=self.aws_config["region"] or "us-east-1",
-            aws_access_key_id=self.aws_config["accessKey"],
-            aws_secret_access_key=self.aws_config["secretKey"],
-        )
+        ec2 = self.get_client(region=self.aws_config["region"] or "us-east-1")
         response = ec2.describe_regions()
         return response["Regions"]
 
+    def get_available_regions(self):
+        # cached next to the login check, see LoginCache
+        return login_cache.regions(self)
+
     def login(self):
-        try:
-            self.ec2 = boto3.client(
-                "ec2",
-                region_name=self.aws_config["region"],
-                aws_access_key_id=self.aws_config["accessKey"],
-                aws_secret_access_key=self.aws_config["secretKey"],
-            )
-        except Exception as awsClientError:
-            raise Exception(f"Error connecting to AWS: {awsClientError}")
+        self.ec2 = self.get_client()
+        return login_cache.check(self)
+
+    def verify_login(self):
+        self.ec2 = self.get_client()
         response = (
             self.ec2.describe_regions(
                 RegionNames=[
@@ -333,14 +640,6 @@ class Aws:
         )
         if response == "not-opted-in":
             raise Exception(f"Error connecting to AWS: {response}")
-        self.resource = boto3.resource(
-            "ec2",
-            region_name=self.aws_config["region"],
-            aws_access_key_id=self.aws_config["accessKey"],
-            aws_secret_access_key=self.aws_config["secretKey"],
-        )
-        if self.resource is None:
-            raise Exception("Error connecting to AWS")
         return True
 
     def get_instance_info(self):
@@ -356,20 +655,17 @@ class Aws:
             raise Exception(f"Error getting instance address: {e}")
 
     def associate_ip(self, ip_address):
-        ec2 = boto3.client(
-            "ec2",
-            region_name=self.aws_config["region"],
-            aws_access_key_id=self.aws_config["accessKey"],
-            aws_secret_access_key=self.aws_config["secretKey"],
-        )
+        ec2 = self.get_client()
         response = ec2.associate_address(
             InstanceId=self.aws_config["instanceId"], PublicIp=ip_address
         )
         return response
 
-    def disassociate_and_release_ip(self):
+    def disassociate_and_release_ip(self, exclude=None):
         response = self.ec2.describe_addresses()
         for address in response["Addresses"]:
+            if address.get("AllocationId") == exclude:
+                continue
             if "Tags" in address:
                 for tag in address["Tags"]:
                     if (
@@ -391,38 +687,110 @@ class Aws:
         return
 
     def allocate_and_associate_ip(self):
-        response = self.ec2.allocate_address(
-            TagSpecifications=[
-                {
-                    "ResourceType": "elastic-ip",
-                    "Tags": [
-                        {"Key": "instance", "Value": self.aws_config["instanceId"]}
-                    ],
-                }
-            ]
-        )
-        self.ec2.associate_address(
-            InstanceId=self.aws_config["instanceId"],
-            AllocationId=response["AllocationId"],
+        instance_id = self.aws_config["instanceId"]
+        tag_specifications = [
+            {
+                "ResourceType": "elastic-ip",
+                "Tags": [{"Key": "instance", "Value": instance_id}],
+            }
+        ]
+        with release_queue.instance_lock(instance_id):
+            try:
+                response = self.ec2.allocate_address(
+                    TagSpecifications=tag_specifications
+                )
+            except Exception as e:
+                if "AddressLimitExceeded" not in str(e):
+                    raise
+                # no room for a second address, break before make instead
+                logger.warning(
+                    f"[{self.config_name}] Elastic IP limit reached, "
+                    + "releasing the old address first"
+                )
+                release_queue.release(self.ec2, instance_id, keep_current=False)
+                response = self.ec2.allocate_address(
+                    TagSpecifications=tag_specifications
+                )
+            # make before break: the new address replaces the old association
+            # and the old one is released in the background
+            self.ec2.associate_address(
+                InstanceId=instance_id,
+                AllocationId=response["AllocationId"],
+                AllowReassociation=True,
+            )
+        release_queue.put(self.ec2, instance_id, response["AllocationId"])
+        return response["PublicIp"]
+
+    def replenish_address_pool(self):
+        address_pool.replenish_async(
+            self.ec2,
+            self.get_client("service-quotas"),
+            (self.aws_config["accessKey"], self.aws_config["region"]),
+            self.aws_config["eipPool"],
         )
-        self.disassociate_and_release_ip()
-        return
 
-    def get_new_ip(self):
+    def associate_pooled_ip(self):
+        key = (self.aws_config["accessKey"], self.aws_config["region"])
+        address = address_pool.take(self.ec2, key)
+        if address is None:
+            return None
+        instance_id = self.aws_config["instanceId"]
+        with release_queue.instance_lock(instance_id):
+            # claim the address first so no other rotation picks it up; the
+            # instance tag also gets it released like any other next time
+            self.ec2.create_tags(
+                Resources=[address["AllocationId"]],
+                Tags=[
+                    {"Key": "role", "Value": "iprotate"},
+                    {"Key": "instance", "Value": instance_id},
+                ],
+            )
+            try:
+                # a stale pool entry must fail instead of moving an address
+                # away from another instance, vpc reassociates unless told not to
+                self.ec2.associate_address(
+                    InstanceId=instance_id,
+                    AllocationId=address["AllocationId"],
+                    AllowReassociation=False,
+                )
+            except Exception as e:
+                logger.warning(
+                    f"[{self.aws_config['configName']}] Pooled address "
+                    + f"{address['PublicIp']} not usable: {e}"
+                )
+                self.ec2.delete_tags(
+                    Resources=[address["AllocationId"]], Tags=[{"Key": "instance"}]
+                )
+                self.ec2.create_tags(
+                    Resources=[address["AllocationId"]], Tags=[pool_tag]
+                )
+                address_pool.untake(key, address["AllocationId"])
+                return None
+        release_queue.put(self.ec2, instance_id, address["AllocationId"])
+        return address["PublicIp"]
+
+    def get_new_ip(self, peer_config=None):
         try:
+            if self.aws_config["instanceId"] != "" and self.aws_config["eipPool"] > 0:
+                logger.info(f"[{self.aws_config['configName']}] Replacing IP from pool")
+                old_ip = self.get_instance_address()
+                new_ip = self.associate_pooled_ip()
+                self.replenish_address_pool()
+                if new_ip is not None:
+                    logger.info(
+                        f"[{self.aws_config['configName']}] old_ip: {old_ip}, new_ip: {new_ip}"
+                    )
+                    return {"old_ip": old_ip, "new_ip": new_ip}
+                logger.warning(
+                    f"[{self.aws_config['configName']}] No pooled address available"
+                )
             if self.aws_config["instanceId"] != "":
                 logger.info(f"[{self.aws_config['configName']}] Replacing IP address")
                 old_ip = self.get_instance_address()
-                logger.info(
-                    f"[{self.aws_config['configName']}] Disassociating and releasing IP"
-                )
-                self.disassociate_and_release_ip()
                 logger.info(
                     f"[{self.aws_config['configName']}] Allocating and associating new IP"
                 )
-                self.allocate_and_associate_ip()
-                logger.info(f"[{self.aws_config['configName']}] Getting new IP address")
-                new_ip = self.get_instance_address()
+                new_ip = self.allocate_and_associate_ip()
                 logger.info(
                     f"[{self.aws_config['configName']}] New IP address: {new_ip}"
                 )
@@ -430,7 +798,7 @@ class Aws:
                 logger.info(f"[{self.aws_config['configName']}] Launching new instance")
                 old_ip = None
                 self.terminate_instance()
-                self.launch_instance()
+                self.launch_instance(peer_config=peer_config)
                 new_ip = self.get_instance_address()
             logger.info(
                 f"[{self.aws_config['configName']}] old_ip: {old_ip}, new_ip: {new_ip}"
@@ -0,0 +1,74 @@
+import json
+import os
+import threading
+import time
+
+import colorlog
+from filelock import FileLock
+
+logger = colorlog.getLogger()
+
+
+class DiskCache:
+    """Small JSON backed key/value cache with per entry expiry.
+
+    Entries are kept in memory and mirrored to cache/<name>.json so they
+    survive restarts. A ttl of 0 keeps entries forever.
+    """
+
+    def __init__(self, name, ttl=0, cache_dir="cache"):
+        self.name = name
+        self.ttl = ttl
+        self.path = f"{cache_dir}/{name}.json"
+        self.lock = threading.Lock()
+        self.data = None
+
+    def load(self):
+        if self.data is not None:
+            return self.data
+        try:
+            with open(self.path, "r") as file:
+                self.data = json.load(file)
+        except FileNotFoundError:
+            self.data = {}
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cache {self.path}: {e}")
+            self.data = {}
+        return self.data
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with FileLock(f"{self.path}.lock"):
+            with open(temp_path, "w") as file:
+                json.dump(self.data, file)
+            os.replace(temp_path, self.path)
+
+    def is_expired(self, entry):
+        return self.ttl and time.time() - entry["time"] > self.ttl
+
+    def get(self, key):
+        with self.lock:
+            entry = self.load().get(key)
+        if entry is None or self.is_expired(entry):
+            return None
+        return entry["value"]
+
+    def set(self, key, value):
+        with self.lock:
+            self.load()[key] = {"time": time.time(), "value": value}
+            self.save()
+
+    def delete(self, key):
+        with self.lock:
+            if self.load().pop(key, None) is not None:
+                self.save()
+
+    def items(self):
+        with self.lock:
+            entries = dict(self.load())
+        return {
+            key: entry["value"]
+            for key, entry in entries.items()
+            if not self.is_expired(entry)
+        }
@@ -0,0 +1,65 @@
+import threading
+
+import boto3
+import colorlog
+from botocore.config import Config
+
+logger = colorlog.getLogger()
+
+
+class ClientPool:
+    """Long-lived boto3 clients shared by every Aws instance.
+
+    boto3 clients are thread-safe once created, sessions are not, so clients
+    are built under a lock and cached per (access key, region, service).
+    """
+
+    def __init__(self, **kwargs):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.clients = {}
+        self.client_config = Config(
+            max_pool_connections=kwargs.get("max_pool_connections", 20),
+            tcp_keepalive=True,
+            connect_timeout=kwargs.get("connect_timeout", 5),
+            read_timeout=kwargs.get("read_timeout", 30),
+            retries={"max_attempts": kwargs.get("max_attempts", 3), "mode": "standard"},
+        )
+
+    def get_session(self, access_key, secret_key):
+        key = (access_key, secret_key)
+        session = self.sessions.get(key)
+        if session is None:
+            session = boto3.session.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+            self.sessions[key] = session
+        return session
+
+    def get_client(self, service, access_key, secret_key, region):
+        key = (service, access_key, secret_key, region)
+        client = self.clients.get(key)
+        if client is not None:
+            return client
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                session = self.get_session(access_key, secret_key)
+                client = session.client(
+                    service, region_name=region, config=self.client_config
+                )
+                self.clients[key] = client
+                logger.debug(f"Created {service} client for {access_key} in {region}")
+            return client
+
+    def discard(self, access_key):
+        # drop everything built from a key, e.g. after credentials were rotated
+        with self.lock:
+            for key in [key for key in self.clients if key[1] == access_key]:
+                self.clients.pop(key, None)
+            for key in [key for key in self.sessions if key[0] == access_key]:
+                self.sessions.pop(key, None)
+
+
+client_pool = ClientPool()
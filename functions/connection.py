@@ -1,8 +1,12 @@
+import asyncio
+import http.client
 import ipaddress
 import os
 import re
+import ssl
+import threading
 from configparser import ConfigParser
-from urllib import request
+from urllib import parse, request
 
 import colorlog
 import pyufw as ufw
@@ -100,32 +104,228 @@ class Firewall:
                 logger.error(e)
 
 
+class SocksHTTPConnection(http.client.HTTPConnection):
+    """An HTTP/1.1 connection tunnelled through a socks5 proxy."""
+
+    def __init__(self, host, port, proxy, timeout):
+        super().__init__(host, port, timeout=timeout)
+        self.proxy = proxy
+
+    def connect(self):
+        self.sock = socks.create_connection(
+            (self.host, self.port),
+            timeout=self.timeout,
+            proxy_type=socks.SOCKS5,
+            proxy_addr=self.proxy["proxy_host"],
+            proxy_port=self.proxy["proxy_port"],
+            proxy_username=self.proxy.get("proxy_user"),
+            proxy_password=self.proxy.get("proxy_pass"),
+        )
+
+
+class Socks5ConnectionPool:
+    """Idle keep-alive connections per proxy, one caller at a time each."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def take(self, key):
+        with self.lock:
+            idle = self.connections.get(key)
+            return idle.pop() if idle else None
+
+    def put(self, key, connection):
+        with self.lock:
+            self.connections.setdefault(key, []).append(connection)
+
+    def close(self, key):
+        with self.lock:
+            idle = self.connections.pop(key, [])
+        for connection in idle:
+            connection.close()
+
+
+socks5_pool = Socks5ConnectionPool()
+
+
 class Socks5:
+    """Fetches the egress address of a profile through its socks5 proxy.
+
+    Every call builds its own opener, so concurrent probes of different
+    profiles never share proxy settings. With persistent=True the socks5
+    session and the HTTP connection behind it are kept in socks5_pool and
+    reused by the next probe of the same proxy.
+    """
+
     def __init__(self, **kwargs):
         self.proxy_host = kwargs.get("proxy_host")
         self.proxy_port = kwargs.get("proxy_port")
         self.proxy_user = kwargs.get("proxy_user") or None
         self.proxy_pass = kwargs.get("proxy_pass") or None
-        self.timeout = 1
+        self.timeout = kwargs.get("timeout") or 1
+        self.url = kwargs.get("url") or "http://ifconfig.me/ip"
+        self.persistent = kwargs.get("persistent", False)
+
+    def proxy(self):
+        return {
+            "proxy_host": self.proxy_host,
+            "proxy_port": int(self.proxy_port),
+            "proxy_user": self.proxy_user,
+            "proxy_pass": self.proxy_pass,
+        }
 
     def get_external_ip(self):
-        opener = request.build_opener(
-            SocksiPyHandler(
-                socks.SOCKS5,
-                self.proxy_host,
-                self.proxy_port,
-                username=self.proxy_user,
-                password=self.proxy_pass,
-            )
-        )
-        request.install_opener(opener)
         try:
-            r = (
-                request.urlopen("http://ifconfig.me/ip", timeout=self.timeout)
-                .read()
-                .decode("utf-8")
+            if self.persistent:
+                return self.get_persistent()
+            opener = request.build_opener(
+                SocksiPyHandler(
+                    socks.SOCKS5,
+                    self.proxy_host,
+                    int(self.proxy_port),
+                    username=self.proxy_user,
+                    password=self.proxy_pass,
+                )
             )
-            return r
-
+            with opener.open(self.url, timeout=self.timeout) as response:
+                return response.read().decode("utf-8").strip()
         except Exception as e:
             raise Exception(f"Failed to get external IP, error: {e}")
+
+    def get_persistent(self):
+        url = parse.urlsplit(self.url)
+        if url.scheme != "http":
+            raise Exception(f"Persistent probes need an http url, got {self.url}")
+        key = (self.proxy_host, self.proxy_port, self.proxy_user, url.netloc)
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        connection = socks5_pool.take(key)
+        # a pooled connection may have been closed by the server meanwhile
+        for reused in [connection is not None, False]:
+            if not reused:
+                connection = SocksHTTPConnection(
+                    url.hostname, url.port or 80, self.proxy(), self.timeout
+                )
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if reused:
+                    continue
+                raise
+            if response.status != 200:
+                connection.close()
+                raise Exception(f"HTTP {response.status} from {self.url}")
+            if response.will_close:
+                connection.close()
+            else:
+                socks5_pool.put(key, connection)
+            return body.decode("utf-8").strip()
+
+    async def get_external_ip_async(self):
+        """Same probe on an asyncio stream, for checking many proxies at once."""
+        url = parse.urlsplit(self.url)
+        if url.scheme not in ["http", "https"]:
+            raise Exception(f"Unsupported url {self.url}")
+        port = url.port or (443 if url.scheme == "https" else 80)
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.proxy_host, int(self.proxy_port)),
+                self.timeout,
+            )
+            await asyncio.wait_for(
+                self.socks5_connect(reader, writer, url.hostname, port), self.timeout
+            )
+            if url.scheme == "https":
+                await writer.start_tls(
+                    ssl.create_default_context(), server_hostname=url.hostname
+                )
+            writer.write(
+                f"GET {path} HTTP/1.1\r\nHost: {url.netloc}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+            )
+            await writer.drain()
+            raw = await asyncio.wait_for(reader.read(), self.timeout)
+        except Exception as e:
+            raise Exception(f"Failed to get external IP, error: {e!r}")
+        finally:
+            if writer is not None:
+                writer.close()
+        head, _, body = raw.partition(b"\r\n\r\n")
+        status = head.split(b"\r\n", 1)[0].split()
+        if len(status) < 2 or status[1] != b"200":
+            raise Exception(f"Failed to get external IP, bad response from {self.url}")
+        if b"transfer-encoding: chunked" in head.lower():
+            body = decode_chunked(body)
+        return body.decode("utf-8").strip()
+
+    async def socks5_connect(self, reader, writer, host, port):
+        if self.proxy_user and self.proxy_pass:
+            writer.write(b"\x05\x01\x02")
+        else:
+            writer.write(b"\x05\x01\x00")
+        await writer.drain()
+        version, method = await reader.readexactly(2)
+        if version != 5 or method == 0xFF:
+            raise Exception("Proxy refused the authentication method")
+        if method == 2:
+            user = self.proxy_user.encode()
+            password = self.proxy_pass.encode()
+            writer.write(
+                bytes([1, len(user)]) + user + bytes([len(password)]) + password
+            )
+            await writer.drain()
+            _, status = await reader.readexactly(2)
+            if status != 0:
+                raise Exception("Proxy rejected the credentials")
+        host = host.encode()
+        writer.write(
+            b"\x05\x01\x00\x03"
+            + bytes([len(host)])
+            + host
+            + port.to_bytes(2, "big")
+        )
+        await writer.drain()
+        version, reply, _, address_type = await reader.readexactly(4)
+        if reply != 0:
+            raise Exception(f"Proxy connect failed with code {reply}")
+        if address_type == 1:
+            await reader.readexactly(4 + 2)
+        elif address_type == 4:
+            await reader.readexactly(16 + 2)
+        else:
+            length = (await reader.readexactly(1))[0]
+            await reader.readexactly(length + 2)
+
+
+def decode_chunked(body):
+    decoded = b""
+    while body:
+        size, _, body = body.partition(b"\r\n")
+        size = int(size.split(b";")[0], 16)
+        if size == 0:
+            break
+        decoded += body[:size]
+        body = body[size + 2 :]
+    return decoded
+
+
+async def get_external_ips(clients, concurrency=50):
+    """Probe many Socks5 clients at once, exceptions are returned in place."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(client):
+        async with semaphore:
+            return await client.get_external_ip_async()
+
+    return await asyncio.gather(
+        *(probe(client) for client in clients), return_exceptions=True
+    )
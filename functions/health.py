@@ -0,0 +1,168 @@
+import asyncio
+import base64
+import datetime
+import threading
+import time
+from urllib import parse
+
+import colorlog
+
+from functions.connection import Socks5, decode_chunked
+from functions.main import ConfigLoader
+
+logger = colorlog.getLogger()
+
+base_socks5_port = 50000
+base_http_port = 60000
+
+
+async def http_proxy_ip(proxy, url, timeout):
+    # plain http through the profile's http proxy, absolute-form request
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(proxy["proxy_host"], proxy["proxy_port"]), timeout
+    )
+    try:
+        headers = f"GET {url} HTTP/1.1\r\nHost: {parse.urlsplit(url).netloc}\r\n"
+        if proxy.get("proxy_user") and proxy.get("proxy_pass"):
+            credentials = base64.b64encode(
+                f"{proxy['proxy_user']}:{proxy['proxy_pass']}".encode()
+            ).decode()
+            headers += f"Proxy-Authorization: Basic {credentials}\r\n"
+        writer.write((headers + "Connection: close\r\n\r\n").encode())
+        await writer.drain()
+        raw = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    head, _, body = raw.partition(b"\r\n\r\n")
+    status = head.split(b"\r\n", 1)[0].split()
+    if len(status) < 2 or status[1] != b"200":
+        raise Exception(f"HTTP {status[1].decode() if len(status) > 1 else '?'}")
+    if b"transfer-encoding: chunked" in head.lower():
+        body = decode_chunked(body)
+    return body.decode("utf-8").strip()
+
+
+class HealthChecker:
+    """Probes the socks5 and http proxy of every profile on an interval.
+
+    Probes run on one asyncio loop in a background thread, at most
+    `healthconcurrency` at a time, and the latest results are kept as a
+    snapshot that /health returns without touching the network.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = {}
+        self.checked_at = None
+        self.checked_time = 0
+        self.worker = None
+
+    async def probe(self, semaphore, kind, proxy, url, timeout):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                if kind == "socks5":
+                    egress_ip = await Socks5(
+                        url=url, timeout=timeout, **proxy
+                    ).get_external_ip_async()
+                else:
+                    egress_ip = await http_proxy_ip(proxy, url, timeout)
+                error = None
+            except Exception as e:
+                egress_ip = None
+                error = str(e) or e.__class__.__name__
+            return {
+                "ok": error is None,
+                "latency_ms": round((time.monotonic() - started) * 1000, 1),
+                "egress_ip": egress_ip,
+                "error": error,
+            }
+
+    async def check_all(self):
+        config = ConfigLoader()
+        api_config = config.api_config
+        url = (
+            api_config["healthUrl"]
+            or api_config["egressCheckUrl"]
+            or "http://ifconfig.me/ip"
+        )
+        timeout = int(api_config["healthTimeout"])
+        semaphore = asyncio.Semaphore(int(api_config["healthConcurrency"]))
+        jobs = []
+        for aws_config in config.all_aws_configs:
+            if not aws_config.get("instanceId"):
+                continue
+            order = int(aws_config["order"])
+            for kind, base_port in [
+                ("socks5", base_socks5_port),
+                ("http", base_http_port),
+            ]:
+                proxy = {
+                    "proxy_host": api_config["publicip"],
+                    "proxy_port": base_port + order,
+                    "proxy_user": aws_config.get("user"),
+                    "proxy_pass": aws_config.get("pass"),
+                }
+                jobs.append(
+                    (
+                        aws_config["configName"],
+                        kind,
+                        self.probe(semaphore, kind, proxy, url, timeout),
+                    )
+                )
+        results = await asyncio.gather(*(job[2] for job in jobs))
+        snapshot = {}
+        for (config_name, kind, _), result in zip(jobs, results):
+            snapshot.setdefault(config_name, {})[kind] = result
+        for profile in snapshot.values():
+            profile["healthy"] = all(result["ok"] for result in profile.values())
+        with self.lock:
+            self.snapshot = snapshot
+            self.checked_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.checked_time = time.time()
+        unhealthy = [
+            name for name, profile in snapshot.items() if not profile["healthy"]
+        ]
+        if unhealthy:
+            logger.warning(f"Unhealthy profiles: {', '.join(unhealthy)}")
+        return snapshot
+
+    def get_profile(self, config_name):
+        with self.lock:
+            return self.snapshot.get(config_name), self.checked_time
+
+    def get_snapshot(self, config_name=None):
+        with self.lock:
+            if config_name:
+                profiles = {config_name: self.snapshot.get(config_name)}
+            else:
+                profiles = dict(self.snapshot)
+            checked_at = self.checked_at
+        return {
+            "checked_at": checked_at,
+            "total": len(profiles),
+            "healthy": sum(1 for p in profiles.values() if p and p["healthy"]),
+            "profiles": profiles,
+        }
+
+    def start(self):
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(
+                target=asyncio.run, args=(self.run(),), daemon=True
+            )
+        self.worker.start()
+
+    async def run(self):
+        while True:
+            interval = int(ConfigLoader().api_config["healthInterval"])
+            if interval > 0:
+                try:
+                    await self.check_all()
+                except Exception as e:
+                    logger.error(f"Health check failed: {e}")
+            await asyncio.sleep(interval if interval > 0 else 60)
+
+
+health_checker = HealthChecker()
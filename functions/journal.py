@@ -0,0 +1,141 @@
+import json
+import os
+import sqlite3
+import threading
+
+import colorlog
+
+logger = colorlog.getLogger()
+
+schema = [
+    """
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        config_name TEXT NOT NULL,
+        task_type TEXT,
+        status TEXT NOT NULL,
+        start_time TEXT NOT NULL,
+        end_time TEXT,
+        data TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS tasks_profile ON tasks (config_name, start_time)",
+    "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)",
+    "CREATE INDEX IF NOT EXISTS tasks_start ON tasks (start_time)",
+]
+
+
+class TaskJournal:
+    """Task state and history kept in an SQLite database.
+
+    Times are stored in the same "%Y-%m-%d %H:%M:%S" format the task manager
+    reports, which sorts lexically, so range queries use the indexes.
+    """
+
+    def __init__(self, path="cache/tasks.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in schema:
+            self.db.execute(statement)
+
+    def to_dict(self, row):
+        task = dict(row)
+        task["task_id"] = task.pop("id")
+        if task["data"] is not None:
+            task["data"] = json.loads(task["data"])
+        return task
+
+    def queue(self, config_name, task_type, time):
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO tasks (config_name, task_type, status, start_time) "
+                + "VALUES (?, ?, 'queued', ?)",
+                (config_name, task_type, time),
+            )
+        return cursor.lastrowid
+
+    def start(self, task_id, start_time):
+        with self.lock:
+            self.db.execute(
+                "UPDATE tasks SET status = 'running', start_time = ? WHERE id = ?",
+                (start_time, task_id),
+            )
+
+    def finish(self, task_id, status, data, end_time):
+        with self.lock:
+            self.db.execute(
+                "UPDATE tasks SET status = ?, end_time = ?, data = ? WHERE id = ?",
+                (status, end_time, json.dumps(data, default=str), task_id),
+            )
+
+    def record(self, config_name, task_type, status, data, time):
+        # a task that failed before it was queued, e.g. on login
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO tasks "
+                + "(config_name, task_type, status, start_time, end_time, data) "
+                + "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    config_name,
+                    task_type,
+                    status,
+                    time,
+                    time,
+                    json.dumps(data, default=str),
+                ),
+            )
+        return cursor.lastrowid
+
+    def recover(self, end_time):
+        """Close tasks cut off by a restart and return the last task per profile."""
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE tasks SET status = 'interrupted', end_time = ? "
+                + "WHERE status IN ('queued', 'running')",
+                (end_time,),
+            )
+            if cursor.rowcount:
+                logger.warning(f"Marked {cursor.rowcount} interrupted tasks in journal")
+            rows = self.db.execute(
+                "SELECT * FROM tasks WHERE id IN "
+                + "(SELECT MAX(id) FROM tasks GROUP BY config_name)"
+            ).fetchall()
+        return {row["config_name"]: self.to_dict(row) for row in rows}
+
+    def get(self, task_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM tasks WHERE id = ?", (task_id,)
+            ).fetchone()
+        return self.to_dict(row) if row else None
+
+    def history(self, config_name=None, since=None, until=None, status=None, limit=100):
+        conditions = []
+        params = []
+        if config_name:
+            conditions.append("config_name = ?")
+            params.append(config_name)
+        if since:
+            conditions.append("start_time >= ?")
+            params.append(since)
+        if until:
+            conditions.append("start_time <= ?")
+            params.append(until)
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        query = "SELECT * FROM tasks"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY start_time DESC, id DESC LIMIT ?"
+        params.append(int(limit))
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [self.to_dict(row) for row in rows]
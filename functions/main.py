@@ -1,6 +1,7 @@
 import configparser
 import json
 import os
+import threading
 
 import colorlog
 from filelock import FileLock
@@ -8,10 +9,66 @@ from filelock import FileLock
 logger = colorlog.getLogger()
 
 
+class ConfigSnapshot:
+    """Process-wide parsed copy of config.conf, refreshed when the file changes.
+
+    The snapshot is read-only: callers get their own copy of the parser so
+    in-memory edits made before write_changes() never leak between them.
+    """
+
+    def __init__(self, path="config.conf"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.data = {}
+
+    def file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def parse(self):
+        parser = configparser.ConfigParser()
+        parser.read(self.path)
+        # order follows section position, it is kept in memory only so a
+        # read never rewrites config.conf
+        counter = 1
+        for section in parser.sections():
+            if section == "api":
+                continue
+            parser.set(section, "order", str(counter))
+            counter += 1
+        return {
+            section: dict(parser.items(section, raw=True))
+            for section in parser.sections()
+        }
+
+    def get(self):
+        stamp = self.file_stamp()
+        with self.lock:
+            if stamp is None or stamp != self.stamp:
+                self.data = self.parse()
+                self.stamp = stamp
+            return self.data
+
+    def invalidate(self):
+        with self.lock:
+            self.stamp = None
+
+    def load(self):
+        parser = configparser.ConfigParser()
+        parser.read_dict(self.get())
+        return parser
+
+
+config_snapshot = ConfigSnapshot()
+
+
 class ConfigLoader:
     def __init__(self):
-        self.config = configparser.ConfigParser()
-        self.config.read("config.conf")
+        self.config = config_snapshot.load()
         self.api_config = self.load_api_config()
         self.all_aws_configs = self.load_all_aws_config()
         self.ssBasePort = 30000
@@ -40,6 +97,7 @@ class ConfigLoader:
             # Write the updated configuration back to the file
             with open("config.conf", "w") as file:
                 temp_config.write(file)
+            config_snapshot.invalidate()
 
     def change_region(self, **kwargs):
         config_name = kwargs.get("config_name")
@@ -50,7 +108,7 @@ class ConfigLoader:
         self.write_changes(config_name)
 
     def reload_config(self):
-        self.config.read("config.conf")
+        self.config = config_snapshot.load()
         self.api_config = self.load_api_config()
         self.all_aws_configs = self.load_all_aws_config()
 
@@ -64,6 +122,35 @@ class ConfigLoader:
             "peerWgPrivateKey": self.config.get("api", "peerwgPrivateKey"),
             "publicip": self.config.get("api", "publicip"),
             "sshKeyPath": self.config.get("api", "sshKeyPath"),
+            "loginCacheTtl": self.config.get("api", "loginCacheTtl", fallback="300"),
+            "loginFailureTtl": self.config.get("api", "loginFailureTtl", fallback="30"),
+            "prewarmImages": self.config.getboolean(
+                "api", "prewarmImages", fallback=False
+            ),
+            "bootstrapTimeout": self.config.get(
+                "api", "bootstrapTimeout", fallback="300"
+            ),
+            "standbyInterval": self.config.get(
+                "api", "standbyInterval", fallback="600"
+            ),
+            "offlinePackages": self.config.getboolean(
+                "api", "offlinePackages", fallback=False
+            ),
+            "maxWorkers": self.config.get("api", "maxWorkers", fallback="8"),
+            "journalPath": self.config.get(
+                "api", "journalPath", fallback="cache/tasks.db"
+            ),
+            "readyTimeout": self.config.get("api", "readyTimeout", fallback="60"),
+            "egressCheckUrl": self.config.get("api", "egressCheckUrl", fallback=""),
+            "healthInterval": self.config.get("api", "healthInterval", fallback="60"),
+            "healthConcurrency": self.config.get(
+                "api", "healthConcurrency", fallback="50"
+            ),
+            "healthTimeout": self.config.get("api", "healthTimeout", fallback="5"),
+            "healthUrl": self.config.get("api", "healthUrl", fallback=""),
+            "healInterval": self.config.get("api", "healInterval", fallback="60"),
+            "healAttempts": self.config.get("api", "healAttempts", fallback="4"),
+            "healBackoff": self.config.get("api", "healBackoff", fallback="30"),
         }
 
     def load_aws_config(self, config_name):
@@ -90,27 +177,52 @@ class ConfigLoader:
             "whitelist": (self.config.get(config_name, "whitelist") or ""),
             "user": (self.config.get(config_name, "user") or ""),
             "pass": (self.config.get(config_name, "pass") or ""),
+            "eipPool": int(self.config.get(config_name, "eipPool", fallback="0") or 0),
+            "goldenImages": self.load_golden_images(config_name),
+            "standbyRegions": [
+                region.strip()
+                for region in self.config.get(
+                    config_name, "standbyRegions", fallback=""
+                ).split(",")
+                if region.strip()
+            ],
+            "standbyState": self.config.get(
+                config_name, "standbyState", fallback="stopped"
+            ),
         }
 
+    def load_golden_images(self, config_name):
+        # goldenimages = us-east-1:ami-0123,eu-west-1:ami-4567
+        golden_images = {}
+        value = self.config.get(config_name, "goldenImages", fallback="")
+        for item in value.split(","):
+            if ":" in item:
+                region, image_id = item.strip().split(":", 1)
+                golden_images[region] = image_id
+        return golden_images
+
+    def set_golden_image(self, config_name, region, image_id):
+        golden_images = self.load_golden_images(config_name)
+        if image_id:
+            golden_images[region] = image_id
+        else:
+            golden_images.pop(region, None)
+        value = ",".join(f"{key}:{value}" for key, value in golden_images.items())
+        self.set_value(config_name, "goldenImages", value)
+        self.write_changes(config_name)
+
     def reset_aws_config_order(self, config_name):
         self.config.set(config_name, "order", "")
-        with open("config.conf", "w") as file:
-            self.config.write(file)
 
     def reorder_aws_config(self, config_name, order: int):
         self.config.set(config_name, "order", str(order))
-        with open("config.conf", "w") as file:
-            self.config.write(file)
 
     def load_all_aws_config(self):
+        # order is already assigned by the snapshot, no disk writes here
         aws_configs = []
-        counter = 1
         for config_name in self.config.sections():
             if config_name == "api":
                 continue
-            self.reset_aws_config_order(config_name)
-            self.reorder_aws_config(config_name, counter)
-            counter += 1
             aws_configs.append(self.load_aws_config(config_name))
         return aws_configs
 
@@ -0,0 +1,79 @@
+import datetime
+import json
+import os
+import shutil
+
+import colorlog
+
+from functions.aws import image_name
+
+logger = colorlog.getLogger()
+
+bundle_packages = ["wireguard", "wireguard-tools"]
+
+
+class PackageBundle:
+    """The .deb files a peer needs, kept on the router per source image.
+
+    A bundle is tied to the image name (which pins the Ubuntu release and
+    build) so it stays valid in every region that image is published in.
+    """
+
+    def __init__(self, image=image_name, base_dir="packages"):
+        self.image = image
+        self.path = f"{base_dir}/{image.replace('/', '_')}"
+
+    def files(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(
+            f"{self.path}/{name}"
+            for name in os.listdir(self.path)
+            if name.endswith(".deb")
+        )
+
+    def manifest(self):
+        try:
+            with open(f"{self.path}/manifest.json", "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def is_available(self):
+        return self.manifest() is not None and bool(self.files())
+
+    def refresh(self, ssh):
+        # download on a peer built from the same image, then pull the files
+        remote_dir = "/tmp/iprotate_bundle"
+        stdin, stdout, stderr = ssh.ssh.exec_command(
+            f"rm -rf {remote_dir} && mkdir -p {remote_dir} && cd {remote_dir} "
+            + "&& sudo apt-get update -y > /dev/null "
+            + f"&& apt-get download {' '.join(bundle_packages)} > /dev/null "
+            + "&& lsb_release -cs && ls *.deb"
+        )
+        output = stdout.read().decode().split()
+        if stdout.channel.recv_exit_status() != 0 or len(output) < 2:
+            raise Exception(f"Failed to download packages: {stderr.read().decode()}")
+        release, deb_files = output[0], output[1:]
+        temp_path = f"{self.path}.tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        sftp = ssh.ssh.open_sftp()
+        try:
+            for deb_file in deb_files:
+                sftp.get(f"{remote_dir}/{deb_file}", f"{temp_path}/{deb_file}")
+        finally:
+            sftp.close()
+        manifest = {
+            "image": self.image,
+            "release": release,
+            "packages": bundle_packages,
+            "files": deb_files,
+            "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        with open(f"{temp_path}/manifest.json", "w") as file:
+            json.dump(manifest, file)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(temp_path, self.path)
+        logger.info(f"Refreshed package bundle for {self.image}: {deb_files}")
+        return manifest
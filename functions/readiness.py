@@ -0,0 +1,72 @@
+import time
+
+import colorlog
+
+from functions.connection import Socks5
+
+logger = colorlog.getLogger()
+
+# WireGuard rekeys every 2 minutes, an older handshake means a dead peer
+handshake_max_age = 180
+
+
+class Readiness:
+    """Decides when a profile tunnel is passing traffic.
+
+    The tunnel is up once the interface has a handshake newer than `since`
+    and has received bytes from the peer, both read from `wg show`. When an
+    echo url is configured, a request through the profile's socks5 proxy
+    must also come back from the expected egress address.
+    """
+
+    def __init__(self, service, **kwargs):
+        self.service = service
+        self.timeout = kwargs.get("timeout") or 60
+        self.interval = kwargs.get("interval") or 0.25
+        self.echo_url = kwargs.get("echo_url") or None
+
+    def tunnel_up(self, since):
+        handshake = self.service.latest_handshake()
+        if handshake <= max(since, time.time() - handshake_max_age):
+            return False
+        received, _ = self.service.transfer()
+        return received > 0
+
+    def egress_ip(self, proxy):
+        try:
+            return Socks5(
+                url=self.echo_url,
+                timeout=2,
+                persistent=self.echo_url.startswith("http://"),
+                **proxy,
+            ).get_external_ip()
+        except Exception as e:
+            logger.debug(e)
+            return None
+
+    def wait(self, since=0, proxy=None, expected_ip=None):
+        """Block until the tunnel is ready, raise when the timeout runs out."""
+        started = time.time()
+        deadline = started + self.timeout
+        while not self.tunnel_up(since):
+            if time.time() >= deadline:
+                raise Exception(
+                    f"Tunnel {self.service.interface_name()} had no handshake "
+                    + f"within {self.timeout}s"
+                )
+            time.sleep(self.interval)
+        result = {"handshake_after": round(time.time() - started, 2)}
+        if self.echo_url is None or proxy is None:
+            return result
+        egress_ip = None
+        while time.time() < deadline:
+            egress_ip = self.egress_ip(proxy)
+            if egress_ip and (expected_ip is None or egress_ip == expected_ip):
+                result["egress_ip"] = egress_ip
+                result["ready_after"] = round(time.time() - started, 2)
+                return result
+            time.sleep(self.interval)
+        raise Exception(
+            f"Egress check through port {proxy['proxy_port']} failed within "
+            + f"{self.timeout}s, got {egress_ip} expected {expected_ip or 'any'}"
+        )
@@ -1,12 +1,15 @@
+import threading
 import time
 
 import colorlog
 
 from functions.aws import Aws
-from functions.connection import Socks5
 from functions.main import ConfigLoader
+from functions.package_bundle import PackageBundle
+from functions.readiness import Readiness
 from functions.service import ServiceManager
 from functions.ssh_setup import SetupHost
+from functions.standby import standby_pool
 
 logger = colorlog.getLogger()
 
@@ -18,6 +21,60 @@ class RunTask:
         self.username = "ubuntu"
         self.basesocks_port = 50000
 
+    def wait_for_bootstrap(self, config_name, service, host, peer_config):
+        # a fresh instance sets itself up through cloud-init, the first
+        # handshake tells us it is done; ssh setup is only the fallback
+        started = int(time.time())
+        service.restart_iprotate_service()
+        timeout = int(self.config.api_config["bootstrapTimeout"])
+        if service.wait_handshake(since=started - 1, timeout=timeout):
+            logger.info(f"[{config_name}] Peer bootstrapped by cloud-init")
+            host.mark_provisioned(peer_config, bootstrapped=True)
+            return
+        logger.warning(f"[{config_name}] No handshake from peer, falling back to ssh")
+        # whatever the ledger says, the peer is not working
+        host.forget_provisioning()
+        host.login()
+        try:
+            host.setup()
+        finally:
+            host.close()
+        host.mark_provisioned(peer_config)
+        service.restart_iprotate_service()
+
+    def verify_new_peer(self, config_name, service, host, peer_config, bootstrapped):
+        endpoint = f"{host.host}:51821"
+        private_key = self.config.api_config["interfaceWgPrivateKey"]
+        peer_public_key = self.config.api_config["peerWgPublicKey"]
+        timeout = int(self.config.api_config["bootstrapTimeout"])
+        if bootstrapped and service.probe_peer(
+            endpoint, private_key, peer_public_key, timeout=timeout
+        ):
+            logger.info(f"[{config_name}] New peer {host.host} answered the probe")
+            host.mark_provisioned(peer_config, bootstrapped=True)
+            return
+        logger.warning(f"[{config_name}] New peer not ready, provisioning over ssh")
+        host.forget_provisioning()
+        host.login()
+        try:
+            host.setup()
+        finally:
+            host.close()
+        if not service.probe_peer(endpoint, private_key, peer_public_key, timeout=30):
+            raise Exception(f"Tunnel to new instance {host.host} did not come up")
+        host.mark_provisioned(peer_config)
+        return
+
+    def wait_ready(self, config_name, service, since, proxy, expected_ip=None):
+        readiness = Readiness(
+            service,
+            timeout=int(self.config.api_config["readyTimeout"]),
+            echo_url=self.config.api_config["egressCheckUrl"],
+        )
+        result = readiness.wait(since=since, proxy=proxy, expected_ip=expected_ip)
+        logger.info(f"[{config_name}] Tunnel is ready: {result}")
+        return result
+
     def change_region(self, **kwargs):
         try:
             config = ConfigLoader()
@@ -34,62 +91,77 @@ class RunTask:
                     "status": "failed",
                     "data": {"message": "New region is the same as the old region"},
                 }
-            aws = Aws(config_name)
-            aws.login()
-            aws.terminate_instance()
-            self.config.change_region(config_name=config_name, new_region=new_region)
-            aws = Aws(config_name)
-            aws.login()
-            logger.info(f"[{config_name}] Launching new instance in {new_region}")
-            aws.launch_instance()
+            old_aws = Aws(config_name)
+            old_aws.login()
+            old_instance_id = old_aws.aws_config["instanceId"]
+            peer_config = config.generate_peer_config(config_name)
+            # make before break: the old instance keeps serving until the new
+            # one has answered a handshake
+            aws, standby_id = standby_pool.take(config_name, new_region)
+            if standby_id:
+                logger.info(f"[{config_name}] Starting standby {standby_id}")
+                aws.start_standby_instance(standby_id)
+            else:
+                logger.info(f"[{config_name}] Launching new instance in {new_region}")
+                aws.aws_config["instanceId"] = aws.run_instance(peer_config=peer_config)
+            new_instance_id = aws.aws_config["instanceId"]
             aws_ip = aws.get_instance_address()
             order = aws.aws_config["order"]
             remote_path = "/etc/wireguard/wg0.conf"
             local_path = f"/opt/cloud-iprotate/profile_config/iprotate_{order}_{config_name}/wg0.conf"
-            config.generate_profile_config(config_name, aws_ip)
-            config.generate_peer_config(config_name)
             host = SetupHost(
                 host=aws_ip,
                 username="ubuntu",
                 key_path=self.key_path,
                 local_path=local_path,
                 remote_path=remote_path,
+                instance_id=new_instance_id,
             )
-            host.login()
-            host.setup()
             service = ServiceManager(f"iprotate_{order}_{config_name}")
-            service.restart_iprotate_service()
+            # a fresh launch carries the peer config in its cloud-init data
+            bootstrapped = not standby_id or host.is_provisioned(peer_config)
+            try:
+                self.verify_new_peer(
+                    config_name, service, host, peer_config, bootstrapped
+                )
+            except Exception:
+                aws.terminate_instance(new_instance_id)
+                raise
+            config.set_value(config_name, "region", new_region)
+            config.set_value(config_name, "instanceId", new_instance_id)
+            config.write_changes(config_name)
+            config.generate_profile_config(config_name, aws_ip)
+            switched = int(time.time())
+            peer_wg_public_key = config.api_config["peerWgPublicKey"]
+            if not service.switch_endpoint(peer_wg_public_key, f"{aws_ip}:51821"):
+                service.restart_iprotate_service()
+            if not service.wait_handshake(since=switched - 1, timeout=30):
+                logger.warning(f"[{config_name}] No handshake after switch, restarting")
+                service.restart_iprotate_service()
+            if old_instance_id:
+                old_aws.terminate_instance(old_instance_id)
+            if standby_id:
+                # refill the pool, the old region may want a standby now
+                threading.Thread(
+                    target=standby_pool.reconcile, args=(config_name,), daemon=True
+                ).start()
             publicip = config.api_config["publicip"]
-            proxy_port = self.basesocks_port + int(order)
-            proxy_user = aws.aws_config["user"]
-            proxy_pass = aws.aws_config["pass"]
-            cconn = Socks5(
-                proxy_host=publicip,
-                proxy_port=proxy_port,
-                proxy_user=proxy_user,
-                proxy_pass=proxy_pass,
+            proxy = {
+                "proxy_host": publicip,
+                "proxy_port": self.basesocks_port + int(order),
+                "proxy_user": aws.aws_config["user"],
+                "proxy_pass": aws.aws_config["pass"],
+            }
+            ready = self.wait_ready(
+                config_name, service, switched - 1, proxy, expected_ip=aws_ip
             )
-            for i in range(5):
-                try:
-                    newip = cconn.get_external_ip()
-                    if newip == aws_ip:
-                        logger.info(
-                            f"[{config_name}] socks5 proxy is ready with external ip: {newip}"
-                        )
-                        break
-                    else:
-                        time.sleep(1)
-                        continue
-                except Exception as e:
-                    logger.warning(e)
-                    time.sleep(1)
-                    continue
             return {
                 "status": "success",
                 "data": {
                     "old_region": old_region,
                     "new_region": new_region,
                     "new_ip": aws_ip,
+                    "ready": ready,
                 },
             }
         except Exception as e:
@@ -102,7 +174,9 @@ class RunTask:
             aws = Aws(config_name)
             aws.login()
             config = ConfigLoader()
-            getnewip = aws.get_new_ip()
+            old_instance_id = aws.aws_config["instanceId"]
+            peer_config = config.generate_peer_config(config_name)
+            getnewip = aws.get_new_ip(peer_config=peer_config)
             aws_ip = getnewip.get("new_ip")
             order = aws.aws_config["order"]
             remote_path = "/etc/wireguard/wg0.conf"
@@ -113,48 +187,206 @@ class RunTask:
                 key_path=self.key_path,
                 local_path=local_path,
                 remote_path=remote_path,
+                instance_id=aws.aws_config["instanceId"],
             )
             config.generate_profile_config(config_name, aws_ip)
-            config.generate_peer_config(config_name)
-            host.login()
-            host.setup()
+            launched = old_instance_id != host.instance_id
+            # an address swap on the same instance leaves the peer untouched,
+            # only the local endpoint has to follow the new ip
+            if not launched and host.is_provisioned(peer_config):
+                logger.info(f"[{config_name}] Peer unchanged, skipping ssh setup")
+            elif not launched:
+                host.login()
+                try:
+                    host.setup()
+                finally:
+                    host.close()
+                host.mark_provisioned(peer_config)
             publicip = config.api_config["publicip"]
             service = ServiceManager(f"iprotate_{order}_{config_name}")
+            started = int(time.time())
             try:
                 service.stop()
             except Exception as e:
                 logger.warning(e)
 
-            service.restart_iprotate_service()
-            proxy_port = self.basesocks_port + int(order)
-            proxy_user = aws.aws_config["user"]
-            proxy_pass = aws.aws_config["pass"]
-            cconn = Socks5(
-                proxy_host=publicip,
-                proxy_port=proxy_port,
-                proxy_user=proxy_user,
-                proxy_pass=proxy_pass,
+            if launched:
+                self.wait_for_bootstrap(config_name, service, host, peer_config)
+            else:
+                service.restart_iprotate_service()
+            proxy = {
+                "proxy_host": publicip,
+                "proxy_port": self.basesocks_port + int(order),
+                "proxy_user": aws.aws_config["user"],
+                "proxy_pass": aws.aws_config["pass"],
+            }
+            getnewip["ready"] = self.wait_ready(
+                config_name, service, started - 1, proxy, expected_ip=aws_ip
             )
-            for i in range(5):
-                try:
-                    newip = cconn.get_external_ip()
-                    if newip == aws_ip:
-                        logger.info(
-                            f"[{config_name}] socks5 proxy is ready with external ip: {newip}"
-                        )
-                        break
-                    else:
-                        time.sleep(1)
-                    continue
-                except Exception as e:
-                    logger.warning(e)
-                    time.sleep(1)
-                    continue
             return {"status": "success", "data": getnewip}
         except Exception as e:
             logger.error(e)
             return {"status": "failed", "data": str(e)}
 
+    def heal(self, **kwargs):
+        try:
+            config_name = kwargs.get("config_name")
+            step = kwargs.get("step")
+            config = ConfigLoader()
+            aws_config = config.load_aws_config(config_name)
+            order = aws_config["order"]
+            service = ServiceManager(f"iprotate_{order}_{config_name}")
+            if step == "relaunch":
+                return self.relaunch(config_name, service)
+            if step == "repush":
+                aws = Aws(config_name)
+                aws.login()
+                aws_ip = aws.get_instance_address()
+                peer_config = config.generate_peer_config(config_name)
+                config.generate_profile_config(config_name, aws_ip)
+                host = SetupHost(
+                    host=aws_ip,
+                    username=self.username,
+                    key_path=self.key_path,
+                    local_path=f"/opt/cloud-iprotate/profile_config/iprotate_{order}_{config_name}/wg0.conf",
+                    remote_path="/etc/wireguard/wg0.conf",
+                    instance_id=aws.aws_config["instanceId"],
+                )
+                # the ledger may claim a peer that lost its config
+                host.forget_provisioning()
+                host.login()
+                try:
+                    host.setup()
+                finally:
+                    host.close()
+                host.mark_provisioned(peer_config)
+            elif step != "restart":
+                return {"status": "failed", "data": f"Unknown heal step {step}"}
+            started = int(time.time())
+            service.restart_iprotate_service()
+            proxy = {
+                "proxy_host": config.api_config["publicip"],
+                "proxy_port": self.basesocks_port + int(order),
+                "proxy_user": aws_config["user"],
+                "proxy_pass": aws_config["pass"],
+            }
+            ready = self.wait_ready(config_name, service, started - 1, proxy)
+            return {"status": "success", "data": {"step": step, "ready": ready}}
+        except Exception as e:
+            logger.error(e)
+            return {"status": "failed", "data": str(e)}
+
+    def relaunch(self, config_name, service):
+        # other profiles may share the account, only replace this peer
+        aws = Aws(config_name)
+        aws.login()
+        config = ConfigLoader()
+        old_instance_id = aws.aws_config["instanceId"]
+        if old_instance_id:
+            aws.terminate_instance(old_instance_id)
+        peer_config = config.generate_peer_config(config_name)
+        instance_id = aws.run_instance(peer_config=peer_config)
+        config.set_value(config_name, "instanceId", instance_id)
+        config.write_changes(config_name)
+        aws.aws_config["instanceId"] = instance_id
+        aws_ip = aws.get_instance_address()
+        order = aws.aws_config["order"]
+        config.generate_profile_config(config_name, aws_ip)
+        host = SetupHost(
+            host=aws_ip,
+            username=self.username,
+            key_path=self.key_path,
+            local_path=f"/opt/cloud-iprotate/profile_config/iprotate_{order}_{config_name}/wg0.conf",
+            remote_path="/etc/wireguard/wg0.conf",
+            instance_id=instance_id,
+        )
+        started = int(time.time())
+        try:
+            service.stop()
+        except Exception as e:
+            logger.warning(e)
+        self.wait_for_bootstrap(config_name, service, host, peer_config)
+        proxy = {
+            "proxy_host": config.api_config["publicip"],
+            "proxy_port": self.basesocks_port + int(order),
+            "proxy_user": aws.aws_config["user"],
+            "proxy_pass": aws.aws_config["pass"],
+        }
+        ready = self.wait_ready(
+            config_name, service, started - 1, proxy, expected_ip=aws_ip
+        )
+        return {
+            "status": "success",
+            "data": {
+                "step": "relaunch",
+                "old_instance_id": old_instance_id,
+                "new_instance_id": instance_id,
+                "new_ip": aws_ip,
+                "ready": ready,
+            },
+        }
+
+    def bake_image(self, **kwargs):
+        try:
+            config_name = kwargs.get("config_name")
+            regions = [
+                region.strip()
+                for region in (kwargs.get("regions") or "").split(",")
+                if region.strip()
+            ]
+            aws = Aws(config_name)
+            aws.login()
+            if aws.aws_config["instanceId"] == "":
+                return {"status": "failed", "data": "Profile has no running instance"}
+            aws_ip = aws.get_instance_address()
+            order = aws.aws_config["order"]
+            config = ConfigLoader()
+            peer_config = config.generate_peer_config(config_name)
+            host = SetupHost(
+                host=aws_ip,
+                username=self.username,
+                key_path=self.key_path,
+                local_path=f"/opt/cloud-iprotate/profile_config/iprotate_{order}_{config_name}/wg0.conf",
+                remote_path="/etc/wireguard/wg0.conf",
+                instance_id=aws.aws_config["instanceId"],
+            )
+            # both steps share one ssh connection
+            host.login()
+            try:
+                host.setup()
+                host.mark_provisioned(peer_config)
+                host.prepare_image()
+            finally:
+                host.close()
+            logger.info(f"[{config_name}] Baking golden image")
+            images = aws.create_golden_image(regions)
+            return {"status": "success", "data": {"images": images}}
+        except Exception as e:
+            logger.error(e)
+            return {"status": "failed", "data": str(e)}
+
+    def refresh_bundle(self, **kwargs):
+        try:
+            config_name = kwargs.get("config_name")
+            aws = Aws(config_name)
+            aws.login()
+            if aws.aws_config["instanceId"] == "":
+                return {"status": "failed", "data": "Profile has no running instance"}
+            host = SetupHost(
+                host=aws.get_instance_address(),
+                username=self.username,
+                key_path=self.key_path,
+            )
+            host.login()
+            try:
+                manifest = PackageBundle().refresh(host.ssh)
+            finally:
+                host.close()
+            return {"status": "success", "data": manifest}
+        except Exception as e:
+            logger.error(e)
+            return {"status": "failed", "data": str(e)}
+
     def change_whitelist(self, **kwargs):
         from functions.connection import Firewall
 
@@ -209,32 +441,22 @@ class RunTask:
             publicip = config.api_config["publicip"]
             service = ServiceManager(f"iprotate_{order}_{config_name}")
             service.stop()
-            proxy_port = self.basesocks_port + int(order)
-            cconn = Socks5(
-                proxy_host=publicip,
-                proxy_port=proxy_port,
-                proxy_user=new_user,
-                proxy_pass=new_pass,
-            )
             service.start()
-            for i in range(5):
-                try:
-                    newip = cconn.get_external_ip()
-                    if newip:
-                        logger.info(
-                            f"[{config_name}] socks5 proxy is ready with external ip: {newip}"
-                        )
-                        break
-                    else:
-                        time.sleep(1)
-                    continue
-                except Exception as e:
-                    logger.warning(e)
-                    time.sleep(1)
-                    continue
+            proxy = {
+                "proxy_host": publicip,
+                "proxy_port": self.basesocks_port + int(order),
+                "proxy_user": new_user,
+                "proxy_pass": new_pass,
+            }
+            # the peer is untouched, any live handshake will do
+            ready = self.wait_ready(config_name, service, 0, proxy)
             return {
                 "status": "success",
-                "data": {"new_user": new_user, "new_pass": new_pass},
+                "data": {
+                    "new_user": new_user,
+                    "new_pass": new_pass,
+                    "ready": ready,
+                },
             }
         except Exception as e:
             logger.error(e)
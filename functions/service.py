@@ -1,4 +1,7 @@
+import itertools
 import os
+import subprocess
+import time
 
 import colorlog
 import dbus
@@ -6,6 +9,10 @@ from systemd_service import Service
 
 logger = colorlog.getLogger()
 
+# probes of one profile may overlap (standby launch and change_region), each
+# needs an interface of its own
+probe_ids = itertools.count()
+
 
 class ServiceManager:
     def __init__(self, service_name):
@@ -26,6 +33,124 @@ class ServiceManager:
             return True
         return False
 
+    def interface_name(self):
+        # iprotate_<order>_<config_name> runs the interface ip_<order>_<config_name>
+        return "ip_" + self.service_name.split("_", 1)[1]
+
+    def latest_handshake(self):
+        result = subprocess.run(
+            ["wg", "show", self.interface_name(), "latest-handshakes"],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0 or not result.stdout.strip():
+            return 0
+        return int(result.stdout.split()[-1])
+
+    def transfer(self):
+        # bytes received and sent through the peer, as `wg show` reports them
+        result = subprocess.run(
+            ["wg", "show", self.interface_name(), "transfer"],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0 or not result.stdout.strip():
+            return 0, 0
+        fields = result.stdout.split()
+        return int(fields[-2]), int(fields[-1])
+
+    def wait_handshake(self, since=0, timeout=300, interval=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.latest_handshake() > since:
+                return True
+            time.sleep(interval)
+        return False
+
+    def probe_peer(self, endpoint, private_key, peer_public_key, timeout=300):
+        """Handshake with a peer on a throwaway interface.
+
+        The probe interface carries the profile's private key, so the peer
+        answers it exactly like the real interface while that one keeps
+        serving traffic through the old peer.
+        """
+        order = self.service_name.split("_")[1]
+        # interface names are limited to 15 characters
+        probe_name = f"probe_{order}_{next(probe_ids) % 1000}"
+        subprocess.run(["ip", "link", "del", "dev", probe_name], capture_output=True)
+        try:
+            subprocess.run(
+                ["ip", "link", "add", "dev", probe_name, "type", "wireguard"],
+                check=True,
+                capture_output=True,
+            )
+            subprocess.run(
+                [
+                    "wg",
+                    "set",
+                    probe_name,
+                    "private-key",
+                    "/dev/stdin",
+                    "peer",
+                    peer_public_key,
+                    "endpoint",
+                    endpoint,
+                    "allowed-ips",
+                    f"10.0.{order}.1/32",
+                    "persistent-keepalive",
+                    "1",
+                ],
+                input=private_key,
+                text=True,
+                check=True,
+                capture_output=True,
+            )
+            subprocess.run(
+                ["ip", "link", "set", "up", "dev", probe_name],
+                check=True,
+                capture_output=True,
+            )
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                result = subprocess.run(
+                    ["wg", "show", probe_name, "latest-handshakes"],
+                    capture_output=True,
+                    text=True,
+                )
+                if result.stdout.strip() and int(result.stdout.split()[-1]) > 0:
+                    return True
+                time.sleep(2)
+            return False
+        finally:
+            subprocess.run(
+                ["ip", "link", "del", "dev", probe_name], capture_output=True
+            )
+
+    def switch_endpoint(self, peer_public_key, endpoint):
+        # re-adding the peer drops the old session so the keepalive starts a
+        # handshake with the new endpoint right away, no interface restart
+        interface_name = self.interface_name()
+        commands = [
+            ["wg", "set", interface_name, "peer", peer_public_key, "remove"],
+            [
+                "wg",
+                "set",
+                interface_name,
+                "peer",
+                peer_public_key,
+                "endpoint",
+                endpoint,
+                "allowed-ips",
+                "0.0.0.0/0",
+                "persistent-keepalive",
+                "25",
+            ],
+        ]
+        for command in commands:
+            if subprocess.run(command, capture_output=True).returncode != 0:
+                return False
+        return True
+
     def stop(self):
         return self.service.stop()
 
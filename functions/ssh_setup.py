@@ -1,14 +1,60 @@
+import base64
+import hashlib
+import os
+import shlex
+import socket
+import threading
 import time
 
 import colorlog
 import paramiko
 
 from functions.aws import Aws
+from functions.cache import DiskCache
 from functions.main import ConfigLoader
+from functions.package_bundle import PackageBundle, bundle_packages
 from functions.service import ServiceManager
 
 logger = colorlog.getLogger()
 
+setup_steps = [
+    "remove_unattended_upgrades",
+    "install_wireguard",
+    "allow_ipv4_forwarding",
+    "enable_wireguard",
+]
+
+
+class ProvisionLedger:
+    """Which setup steps ran on an instance and which peer config it has.
+
+    Entries are keyed by instance id and expire after a day, after which the
+    instance gets a full provisioning run again.
+    """
+
+    def __init__(self, ttl=24 * 3600):
+        self.cache = DiskCache("ledger", ttl=ttl)
+
+    def get(self, instance_id):
+        entry = self.cache.get(instance_id) if instance_id else None
+        return entry or {"steps": [], "config_hash": None}
+
+    def record(self, instance_id, steps=None, config_hash=None):
+        if not instance_id:
+            return
+        entry = self.get(instance_id)
+        entry["steps"] = sorted(set(entry["steps"]) | set(steps or []))
+        if config_hash is not None:
+            entry["config_hash"] = config_hash
+        self.cache.set(instance_id, entry)
+
+    def forget(self, instance_id):
+        if instance_id:
+            self.cache.delete(instance_id)
+
+
+provision_ledger = ProvisionLedger()
+
 
 class SSHSetup:
     def __init__(self, **kwargs):
@@ -19,21 +65,42 @@ class SSHSetup:
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.change_eth_script_path = "/opt/cloud-iprotate/change_eth.sh"
 
+    def wait_for_ssh(self, timeout=300):
+        # a cheap tcp probe with backoff until sshd sends its banner
+        delay = 0.25
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                with socket.create_connection((self.host, 22), timeout=2) as sock:
+                    sock.settimeout(2)
+                    if sock.recv(4).startswith(b"SSH-"):
+                        return True
+            except OSError:
+                pass
+            time.sleep(delay)
+            delay = min(delay * 2, 4)
+        return False
+
     def connect(self, **kwargs):
-        # try up to 10 times to connect to the remote host with timeout 1 second
-        tries = kwargs.get("tries", 10)
+        tries = kwargs.get("tries", 5)
+        if not self.wait_for_ssh(kwargs.get("timeout", 300)):
+            logger.warning(f"sshd on {self.host} did not come up")
+            return False
+        # sshd is up, retries only cover the key not being installed yet
+        delay = 1
         for i in range(tries):
             try:
                 self.ssh.connect(
                     self.host,
                     username=self.username,
                     key_filename=self.key_path,
-                    timeout=2.0,
+                    timeout=5.0,
                 )
                 break
             except Exception:
                 logger.warning(f"Failed to connect to {self.host} on try {i + 1}")
-                time.sleep(1)
+                time.sleep(delay)
+                delay = min(delay * 2, 8)
             if i == tries - 1:
                 logger.warning(
                     "Failed to connect to "
@@ -47,6 +114,10 @@ class SSHSetup:
             return False
         return True
 
+    def is_connected(self):
+        transport = self.ssh.get_transport()
+        return transport is not None and transport.is_active()
+
     def is_file_exists(self, remote_path):
         stdin, stdout, stderr = self.ssh.exec_command(
             f'sudo test -f {remote_path} && echo "File exists" || echo "File does not exist"'
@@ -55,11 +126,12 @@ class SSHSetup:
         return output == "File exists"
 
     def is_package_installed(self, package_name):
+        # unpacked but unconfigured packages (dpkg status iU) do not count
         stdin, stdout, stderr = self.ssh.exec_command(
-            f"sudo dpkg -l | grep {package_name}"
+            f"dpkg-query -W -f='${{Status}}' {package_name} 2>/dev/null"
         )
         output = stdout.read().decode().strip()
-        return output != ""
+        return output == "install ok installed"
 
     def install_package(self, package_name):
         is_installed = self.is_package_installed(package_name)
@@ -74,6 +146,31 @@ class SSHSetup:
             return False
         return True
 
+    def install_bundle(self, bundle):
+        # dpkg -i the router's cached .deb files, no apt update on the peer
+        remote_dir = "/tmp/iprotate_debs"
+        self.ssh.exec_command(f"mkdir -p {remote_dir}")[1].channel.recv_exit_status()
+        sftp = self.ssh.open_sftp()
+        try:
+            for local_path in bundle.files():
+                sftp.put(local_path, f"{remote_dir}/{os.path.basename(local_path)}")
+        finally:
+            sftp.close()
+        stdin, stdout, stderr = self.ssh.exec_command(
+            f"sudo dpkg -i {remote_dir}/*.deb && rm -rf {remote_dir}"
+        )
+        stdout.read()
+        if stdout.channel.recv_exit_status() == 0:
+            return True
+        # missing dependencies leave the packages unpacked but unconfigured,
+        # purge them so the apt fallback starts from a clean state
+        stdin, stdout, stderr = self.ssh.exec_command(
+            f"sudo dpkg --purge {' '.join(bundle_packages)}; rm -rf {remote_dir}"
+        )
+        stdout.read()
+        stdout.channel.recv_exit_status()
+        return False
+
     def remove_package(self, package_name):
         stdin, stdout, stderr = self.ssh.exec_command(
             f"sudo apt remove {package_name} -y && sudo apt autoremove -y && sudo apt purge {package_name} -y"
@@ -150,6 +247,101 @@ class SSHSetup:
         is_file_exists = self.is_file_exists(remote_path)
         return is_file_exists
 
+    def remote_checksums(self, remote_paths):
+        # the .sha256 sidecar holds what we installed, scripts like
+        # change_eth.sh may rewrite the file itself afterwards
+        script = "; ".join(
+            f"echo $(test -f {path} && (cat {path}.sha256 2>/dev/null "
+            + f"|| sha256sum {path} | cut -c1-64))"
+            for path in map(shlex.quote, remote_paths)
+        )
+        stdin, stdout, stderr = self.ssh.exec_command(
+            f"sudo sh -c {shlex.quote(script)}"
+        )
+        checksums = stdout.read().decode().split("\n")
+        return {
+            path: checksums[i].strip() if i < len(checksums) else ""
+            for i, path in enumerate(remote_paths)
+        }
+
+    def put_files(self, files):
+        """Install (local_path, remote_path, mode) files as root.
+
+        Files whose remote checksum already matches are skipped, the rest go
+        through one sftp session and one privileged install command.
+        Returns the remote paths that were changed.
+        """
+        local_checksums = {}
+        for local_path, remote_path, mode in files:
+            with open(local_path, "rb") as file:
+                local_checksums[remote_path] = hashlib.sha256(file.read()).hexdigest()
+        remote_checksums = self.remote_checksums([file[1] for file in files])
+        changed = [
+            file
+            for file in files
+            if remote_checksums.get(file[1]) != local_checksums[file[1]]
+        ]
+        if not changed:
+            return []
+        commands = []
+        sftp = self.ssh.open_sftp()
+        try:
+            for index, (local_path, remote_path, mode) in enumerate(changed):
+                temp_path = f"/tmp/iprotate_upload_{index}"
+                sftp.put(local_path, temp_path)
+                remote = shlex.quote(remote_path)
+                commands.append(
+                    f"install -D -m {mode} {temp_path} {remote} && rm -f {temp_path} "
+                    + f"&& echo {local_checksums[remote_path]} > {remote}.sha256"
+                )
+        finally:
+            sftp.close()
+        stdin, stdout, stderr = self.ssh.exec_command(
+            f"sudo sh -c {shlex.quote(' && '.join(commands))}"
+        )
+        stdout.read()
+        if stdout.channel.recv_exit_status() != 0:
+            raise Exception(
+                f"Failed to install files on {self.host}: {stderr.read().decode()}"
+            )
+        return [file[1] for file in changed]
+
+    def run_batch(self, steps):
+        """Run (name, command) steps as root in a single remote script.
+
+        Every step runs even if an earlier one failed, like the one command
+        per step methods above. Returns the exit code, duration in ms and the
+        tail of the output of each step.
+        """
+        script = ["export DEBIAN_FRONTEND=noninteractive"]
+        for name, command in steps:
+            script.append(
+                "start=$(date +%s%N); "
+                + f"output=$( {{ {command} ; }} 2>&1 ); code=$?; "
+                + "end=$(date +%s%N); "
+                + "printf 'IPROTATE_STEP\\t%s\\t%s\\t%s\\t%s\\n' "
+                + f"{shlex.quote(name)} $code $(( (end - start) / 1000000 )) "
+                + '"$(printf %s "$output" | tail -c 1000 | base64 -w0)"'
+            )
+        stdin, stdout, stderr = self.ssh.exec_command("sudo bash -s")
+        stdin.write("\n".join(script) + "\n")
+        stdin.channel.shutdown_write()
+        output = stdout.read().decode()
+        results = []
+        for line in output.splitlines():
+            fields = line.split("\t")
+            if len(fields) != 5 or fields[0] != "IPROTATE_STEP":
+                continue
+            results.append(
+                {
+                    "name": fields[1],
+                    "exit_code": int(fields[2]),
+                    "duration_ms": int(fields[3]),
+                    "output": base64.b64decode(fields[4]).decode(errors="replace"),
+                }
+            )
+        return results
+
     def execute_script(self, script_path):
         stdin, stdout, stderr = self.ssh.exec_command(f"sudo bash {script_path}")
         output = stdout.read().decode().strip()
@@ -159,6 +351,36 @@ class SSHSetup:
         self.ssh.close()
 
 
+class SSHConnectionPool:
+    """One authenticated connection per host, reused for a whole task."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def get(self, host, username, key_path):
+        key = (host, username)
+        with self.lock:
+            connection = self.connections.get(key)
+        if connection is not None and connection.is_connected():
+            return connection
+        connection = SSHSetup(host=host, username=username, key_path=key_path)
+        if not connection.connect():
+            raise Exception(f"Failed to connect to {host}")
+        with self.lock:
+            self.connections[key] = connection
+        return connection
+
+    def close(self, host, username):
+        with self.lock:
+            connection = self.connections.pop((host, username), None)
+        if connection is not None:
+            connection.close()
+
+
+ssh_pool = SSHConnectionPool()
+
+
 class SetupHost:
     def __init__(self, **kwargs):
         self.host = kwargs.get("host")
@@ -166,18 +388,41 @@ class SetupHost:
         self.key_path = kwargs.get("key_path")
         self.local_path = kwargs.get("local_path")
         self.remote_path = kwargs.get("remote_path")
+        self.instance_id = kwargs.get("instance_id")
         self.change_eth_script_path = "/opt/cloud-iprotate/change_eth.sh"
+        self.ssh = None
 
-    def login(self):
-        self.ssh = SSHSetup(
-            host=self.host, username=self.username, key_path=self.key_path
+    def config_hash(self, peer_config):
+        return hashlib.sha256(peer_config.encode()).hexdigest()
+
+    def is_provisioned(self, peer_config):
+        if not self.instance_id:
+            return False
+        entry = provision_ledger.get(self.instance_id)
+        return entry["config_hash"] == self.config_hash(peer_config) and set(
+            setup_steps
+        ) <= set(entry["steps"])
+
+    def mark_provisioned(self, peer_config, bootstrapped=False):
+        # a cloud-init bootstrap runs every setup step in one go
+        provision_ledger.record(
+            self.instance_id,
+            steps=setup_steps if bootstrapped else None,
+            config_hash=self.config_hash(peer_config),
         )
-        self.ssh.connect()
+
+    def forget_provisioning(self):
+        provision_ledger.forget(self.instance_id)
+
+    def login(self):
+        self.ssh = ssh_pool.get(self.host, self.username, self.key_path)
         logger.info(f"Connected to {self.host}")
 
-    def setup(self):
+    def setup(self, batched=True):
         if not self.ssh:
             return False
+        if batched:
+            return self.setup_batched()
         if self.ssh.is_package_installed("unattended-upgrades"):
             logger.info("Removing unattended-upgrades")
             self.ssh.remove_package("unattended-upgrades")
@@ -194,15 +439,110 @@ class SetupHost:
         self.ssh.execute_script("/tmp/change_eth.sh")
         self.ssh.enable_service("wg-quick@wg0")
         self.ssh.restart_service("wg-quick@wg0")
-        self.ssh.close()
+
+    def setup_batched(self):
+        ledger = provision_ledger.get(self.instance_id)
+        with open(self.local_path, "r") as file:
+            config_hash = self.config_hash(file.read())
+        change_eth_remote_path = "/opt/iprotate/change_eth.sh"
+        changed = []
+        if ledger["config_hash"] != config_hash:
+            changed = self.ssh.put_files(
+                [
+                    (self.local_path, self.remote_path, "0600"),
+                    (self.change_eth_script_path, change_eth_remote_path, "0755"),
+                ]
+            )
+        if changed:
+            logger.info(f"[{self.host}] Updated {', '.join(changed)}")
+        else:
+            logger.info(f"[{self.host}] Remote files are up to date")
+        steps = [
+            (
+                "remove_unattended_upgrades",
+                "if dpkg -l | grep -q unattended-upgrades; then "
+                + "apt remove unattended-upgrades -y && apt autoremove -y "
+                + "&& apt purge unattended-upgrades -y; fi",
+            ),
+            (
+                "install_wireguard",
+                "dpkg-query -W -f='${Status}' wireguard 2>/dev/null "
+                + '| grep -q "install ok installed" || '
+                + "(apt update -y && apt install wireguard -y)",
+            ),
+            (
+                "allow_ipv4_forwarding",
+                'echo "net.ipv4.ip_forward = 1" > /etc/sysctl.d/99-sysctl.conf '
+                + "&& sysctl -p",
+            ),
+            (
+                "enable_wireguard",
+                "systemctl enable --now wg-quick@wg0",
+            ),
+        ]
+        # only steps the ledger has not seen succeed on this instance, the
+        # unit is always (re)enabled since it is cheap and the ledger can lie
+        steps = [
+            step
+            for step in steps
+            if step[0] not in ledger["steps"] or step[0] == "enable_wireguard"
+        ]
+        if "install_wireguard" in [step[0] for step in steps]:
+            installed_steps = self.install_from_bundle()
+            steps = [step for step in steps if step[0] not in installed_steps]
+        if self.remote_path in changed:
+            steps.insert(0, ("change_eth", f"bash {change_eth_remote_path}"))
+            steps.append(("restart_wireguard", "systemctl restart wg-quick@wg0"))
+        results = []
+        if steps:
+            results = self.ssh.run_batch(steps)
+        for result in results:
+            if result["exit_code"] != 0:
+                logger.warning(
+                    f"[{self.host}] {result['name']} failed "
+                    + f"({result['exit_code']}): {result['output']}"
+                )
+            else:
+                logger.info(
+                    f"[{self.host}] {result['name']} done in {result['duration_ms']}ms"
+                )
+        provision_ledger.record(
+            self.instance_id,
+            steps=[
+                result["name"]
+                for result in results
+                if result["exit_code"] == 0 and result["name"] in setup_steps
+            ],
+            config_hash=config_hash,
+        )
+        return results
+
+    def install_from_bundle(self):
+        if not ConfigLoader().api_config["offlinePackages"]:
+            return []
+        bundle = PackageBundle()
+        if not bundle.is_available():
+            logger.info(f"[{self.host}] No package bundle yet, using apt")
+            return []
+        if self.ssh.is_package_installed("wireguard") or self.ssh.install_bundle(
+            bundle
+        ):
+            logger.info(f"[{self.host}] Wireguard installed from package bundle")
+            provision_ledger.record(self.instance_id, steps=["install_wireguard"])
+            return ["install_wireguard"]
+        logger.warning(f"[{self.host}] Package bundle install failed, using apt")
+        return []
+
+    def prepare_image(self):
+        # boot time jobs that would compete with the peer setup on new instances
+        for service_name in ["apt-daily.timer", "apt-daily-upgrade.timer"]:
+            self.ssh.disable_service(service_name)
 
     def close(self):
         if not self.ssh:
             return False
-        self.ssh = SSHSetup(
-            host=self.host, username=self.username, key_path=self.key_path
-        )
-        self.ssh.close()
+        ssh_pool.close(self.host, self.username)
+        self.ssh = None
 
 
 if __name__ == "__main__":
@@ -241,7 +581,10 @@ if __name__ == "__main__":
                 remote_path=remote_path,
             )
             host.login()
-            host.setup()
+            try:
+                host.setup()
+            finally:
+                host.close()
     peerconnect = SSHSetup(host=peer_ip, username=username, key_path=key_path)
     if not peerconnect.connect():
         host = SetupHost(
@@ -252,4 +595,7 @@ if __name__ == "__main__":
             remote_path=remote_path,
         )
         host.login()
-        host.setup()
+        try:
+            host.setup()
+        finally:
+            host.close()
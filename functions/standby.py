@@ -0,0 +1,185 @@
+import threading
+import time
+
+import colorlog
+
+from functions.aws import Aws
+from functions.main import ConfigLoader
+from functions.service import ServiceManager
+from functions.ssh_setup import SetupHost
+
+logger = colorlog.getLogger()
+
+
+class StandbyPool:
+    """Pre-provisioned instances waiting in other regions of a profile.
+
+    Profiles list regions in standbyregions; the reconciler keeps exactly one
+    instance tagged role=iprotate-standby per region, bootstrapped through
+    cloud-init and then stopped (or left running with standbystate =
+    running). change_region claims one with take() instead of launching.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {}
+        self.worker = None
+
+    def reconcile(self, config_name):
+        config = ConfigLoader()
+        aws_config = config.load_aws_config(config_name)
+        wanted = set(aws_config["standbyRegions"]) - {aws_config["region"]}
+        with self.lock:
+            known = set(self.state.get(config_name, {}))
+        peer_config = None
+        state = {}
+        for region in sorted(wanted | known):
+            try:
+                aws = Aws(config_name, region=region)
+                aws.login()
+                instances = aws.list_standby_instances()
+                if region not in wanted:
+                    for instance in instances:
+                        if self.is_standby(aws, instance["InstanceId"]):
+                            aws.terminate_instance(instance["InstanceId"])
+                    continue
+                for instance in instances[1:]:
+                    if self.is_standby(aws, instance["InstanceId"]):
+                        aws.terminate_instance(instance["InstanceId"])
+                if not instances:
+                    if peer_config is None:
+                        peer_config = config.generate_peer_config(config_name)
+                    instance_id = self.launch(aws, peer_config)
+                    state[region] = {"instance_id": instance_id, "state": "pending"}
+                    continue
+                instance = instances[0]
+                instance_state = instance["State"]["Name"]
+                if (
+                    instance_state == "running"
+                    and aws_config["standbyState"] != "running"
+                ):
+                    # stopping in the middle of cloud-init's apt run breaks it
+                    if not self.wait_cloud_init(aws, instance):
+                        instance_state = "bootstrapping"
+                    elif not self.is_standby(aws, instance["InstanceId"]):
+                        # change_region claimed it while cloud-init ran
+                        continue
+                    else:
+                        aws.ec2.stop_instances(InstanceIds=[instance["InstanceId"]])
+                        instance_state = "stopping"
+                state[region] = {
+                    "instance_id": instance["InstanceId"],
+                    "state": instance_state,
+                }
+            except Exception as e:
+                logger.warning(
+                    f"[{config_name}] Standby reconcile in {region} failed: {e}"
+                )
+                state[region] = {"instance_id": None, "state": "error", "error": str(e)}
+        with self.lock:
+            self.state[config_name] = state
+        return state
+
+    def is_standby(self, aws, instance_id):
+        # the listing may be minutes old, take() retags claimed instances
+        response = aws.ec2.describe_instances(InstanceIds=[instance_id])
+        instance = response["Reservations"][0]["Instances"][0]
+        return {"Key": "role", "Value": "iprotate-standby"} in instance.get("Tags", [])
+
+    def launch(self, aws, peer_config):
+        logger.info(
+            f"[{aws.config_name}] Launching standby in {aws.aws_config['region']}"
+        )
+        instance_id = aws.run_instance(
+            peer_config=peer_config,
+            tags=[
+                {"Key": "role", "Value": "iprotate-standby"},
+                {"Key": "profile", "Value": aws.config_name},
+            ],
+        )
+        aws.ec2.get_waiter("instance_status_ok").wait(InstanceIds=[instance_id])
+        # only a peer that answered a handshake counts as bootstrapped, else
+        # taking it later provisions it over ssh
+        aws.aws_config["instanceId"] = instance_id
+        config = ConfigLoader()
+        service = ServiceManager(
+            f"iprotate_{aws.aws_config['order']}_{aws.config_name}"
+        )
+        if service.probe_peer(
+            f"{aws.get_instance_address()}:51821",
+            config.api_config["interfaceWgPrivateKey"],
+            config.api_config["peerWgPublicKey"],
+            timeout=int(config.api_config["bootstrapTimeout"]),
+        ):
+            SetupHost(instance_id=instance_id).mark_provisioned(
+                peer_config, bootstrapped=True
+            )
+        else:
+            logger.warning(
+                f"[{aws.config_name}] Standby {instance_id} did not answer the probe"
+            )
+        return instance_id
+
+    def wait_cloud_init(self, aws, instance, timeout=600):
+        address = instance.get("PublicIpAddress")
+        if not address:
+            return False
+        host = SetupHost(
+            host=address,
+            username="ubuntu",
+            key_path=ConfigLoader().api_config["sshKeyPath"],
+        )
+        try:
+            host.login()
+            stdin, stdout, stderr = host.ssh.ssh.exec_command(
+                f"timeout {timeout} cloud-init status --wait"
+            )
+            stdout.read()
+            # 1 and 2 mean finished with errors, the ssh fallback fixes those;
+            # timeout exits with 124
+            return stdout.channel.recv_exit_status() in [0, 1, 2]
+        except Exception as e:
+            logger.warning(
+                f"[{aws.config_name}] Waiting for cloud-init on {address} failed: {e}"
+            )
+            return False
+        finally:
+            host.close()
+
+    def take(self, config_name, region):
+        aws = Aws(config_name, region=region)
+        aws.login()
+        for instance in aws.list_standby_instances():
+            if instance["State"]["Name"] in ["running", "stopped"]:
+                with self.lock:
+                    self.state.get(config_name, {}).pop(region, None)
+                return aws, instance["InstanceId"]
+        return aws, None
+
+    def get_state(self, config_name):
+        with self.lock:
+            return dict(self.state.get(config_name, {}))
+
+    def reconcile_all(self):
+        for aws_config in ConfigLoader().all_aws_configs:
+            if aws_config["standbyRegions"] or self.get_state(aws_config["configName"]):
+                self.reconcile(aws_config["configName"])
+
+    def start(self):
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            try:
+                self.reconcile_all()
+            except Exception as e:
+                logger.error(f"Standby reconcile failed: {e}")
+            interval = int(ConfigLoader().api_config["standbyInterval"])
+            time.sleep(interval)
+
+
+standby_pool = StandbyPool()
@@ -0,0 +1,188 @@
+import collections
+import threading
+import time
+
+import colorlog
+
+from functions.health import health_checker
+from functions.main import ConfigLoader
+from functions.readiness import handshake_max_age
+from functions.service import ServiceManager
+
+logger = colorlog.getLogger()
+
+# cheapest repair first, every failed attempt moves one step up
+heal_steps = ["restart", "repush", "rotate", "relaunch"]
+# a failing probe may be the echo site's fault, never rotate or relaunch for it
+probe_heal_steps = ["restart"]
+probe_failure_threshold = 3
+finished_states = ["success", "failed", "interrupted"]
+
+
+class Supervisor:
+    """Repairs profiles whose tunnel died without anyone noticing.
+
+    A profile is watched once it has been seen with a fresh handshake. When
+    its handshake goes stale, an incident is opened and repairs are queued
+    through the task manager, one step per attempt, with exponential backoff
+    and at most healattempts attempts per incident. Several failed health
+    probes in a row only earn a service restart. The incident closes once the
+    profile is healthy again and its duration feeds the mean time to recovery.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.task_manager = None
+        self.watched = set()
+        self.incidents = {}
+        self.recoveries = collections.deque(maxlen=100)
+        self.probe_failures = {}
+        self.probe_checked = {}
+        self.worker = None
+
+    def diagnose(self, aws_config, incident):
+        service = ServiceManager(
+            f"iprotate_{aws_config['order']}_{aws_config['configName']}"
+        )
+        handshake = service.latest_handshake()
+        if time.time() - handshake > handshake_max_age:
+            return "stale handshake"
+        config_name = aws_config["configName"]
+        health, checked_time = health_checker.get_profile(config_name)
+        if checked_time > self.probe_checked.get(config_name, 0):
+            self.probe_checked[config_name] = checked_time
+            if health and not health["healthy"]:
+                self.probe_failures[config_name] = (
+                    self.probe_failures.get(config_name, 0) + 1
+                )
+            else:
+                self.probe_failures[config_name] = 0
+        if self.probe_failures.get(config_name, 0) < probe_failure_threshold:
+            return None
+        # a probe taken before the last repair says nothing about it, keep
+        # the incident open until a newer one comes in
+        last_step_time = incident.get("last_step_time", 0) if incident else 0
+        if checked_time <= last_step_time:
+            return incident["reason"]
+        return "health probe failed"
+
+    def check(self, aws_config):
+        config_name = aws_config["configName"]
+        with self.lock:
+            incident = self.incidents.get(config_name)
+        if incident and incident.get("task_id"):
+            task = self.task_manager.get_task(incident["task_id"])
+            if task and task["status"] not in finished_states:
+                return
+            incident["task_id"] = None
+            incident["last_result"] = task["status"] if task else None
+        if config_name in self.task_manager.running:
+            # a user task is working on the profile already
+            return
+        reason = self.diagnose(aws_config, incident)
+        if reason is None:
+            self.watched.add(config_name)
+            if incident:
+                self.close_incident(config_name, incident)
+            return
+        if config_name not in self.watched:
+            return
+        now = time.time()
+        if incident is None:
+            logger.warning(f"[{config_name}] Tunnel unhealthy: {reason}")
+            incident = {
+                "since": now,
+                "reason": reason,
+                "attempts": 0,
+                "next_try": now,
+                "task_id": None,
+            }
+            with self.lock:
+                self.incidents[config_name] = incident
+        incident["reason"] = reason
+        api_config = ConfigLoader().api_config
+        steps = heal_steps if reason == "stale handshake" else probe_heal_steps
+        budget = int(api_config["healAttempts"])
+        if reason != "stale handshake":
+            budget = min(budget, len(steps))
+        if incident["attempts"] >= budget:
+            if not incident.get("exhausted"):
+                logger.error(f"[{config_name}] Auto-heal gave up: {reason}")
+                incident["exhausted"] = True
+            return
+        if now < incident["next_try"]:
+            return
+        step = steps[min(incident["attempts"], len(steps) - 1)]
+        if step == "rotate":
+            kwargs = {"task_type": "change_ip", "config_name": config_name}
+        else:
+            kwargs = {"task_type": "heal", "config_name": config_name, "step": step}
+        ticket = self.task_manager.submit(kwargs)
+        logger.info(
+            f"[{config_name}] Auto-heal step {step} ({reason}), "
+            + f"task {ticket['task_id']}"
+        )
+        incident["attempts"] += 1
+        incident["step"] = step
+        incident["task_id"] = ticket["task_id"]
+        incident["last_step_time"] = now
+        backoff = int(api_config["healBackoff"]) * 2 ** (incident["attempts"] - 1)
+        incident["next_try"] = now + backoff
+
+    def close_incident(self, config_name, incident):
+        duration = time.time() - incident["since"]
+        with self.lock:
+            self.incidents.pop(config_name, None)
+            self.recoveries.append(duration)
+        logger.info(
+            f"[{config_name}] Tunnel recovered after {round(duration)}s "
+            + f"and {incident['attempts']} repair attempts"
+        )
+
+    def get_state(self, config_name=None):
+        with self.lock:
+            incidents = {
+                name: dict(incident)
+                for name, incident in self.incidents.items()
+                if config_name is None or name == config_name
+            }
+            recoveries = list(self.recoveries)
+        return {
+            "incidents": incidents,
+            "metrics": {
+                "open_incidents": len(incidents),
+                "recoveries": len(recoveries),
+                "mttr_seconds": (
+                    round(sum(recoveries) / len(recoveries), 1) if recoveries else None
+                ),
+            },
+        }
+
+    def check_all(self):
+        for aws_config in ConfigLoader().all_aws_configs:
+            if not aws_config.get("instanceId"):
+                continue
+            try:
+                self.check(aws_config)
+            except Exception as e:
+                logger.warning(
+                    f"[{aws_config['configName']}] Auto-heal check failed: {e}"
+                )
+
+    def start(self, task_manager):
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.task_manager = task_manager
+            self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self):
+        while True:
+            interval = int(ConfigLoader().api_config["healInterval"])
+            if interval > 0:
+                self.check_all()
+            time.sleep(interval if interval > 0 else 60)
+
+
+supervisor = Supervisor()
@@ -1,7 +1,11 @@
+import collections
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import colorlog
 
+from functions.journal import TaskJournal
 from functions.main import ConfigLoader
 from functions.run import RunTask
 
@@ -10,18 +14,29 @@ logger = colorlog.getLogger()
 
 class TaskManager:
     def __init__(self):
-        # Get the current time with timezone information
-        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        # local time, like every other timestamp in the journal
+        now = datetime.datetime.now()
         self.timestamp_format = "%Y-%m-%d %H:%M:%S"
         self.init_time = now.strftime(self.timestamp_format)
-        all_aws = ConfigLoader().load_all_aws_config()
+        config = ConfigLoader()
+        all_aws = config.load_all_aws_config()
+        # tasks of one profile run in order, profiles share the worker pool
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.running = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(config.api_config["maxWorkers"]),
+            thread_name_prefix="task",
+        )
+        self.journal = TaskJournal(config.api_config["journalPath"])
+        last_tasks = self.journal.recover(now.strftime(self.timestamp_format))
         self.profile = {}
         for aws in all_aws:
             aws_detail = {}
             aws_detail["config_name"] = aws.get("configName")
             aws_detail["status"] = "idle"
             aws_detail["aws_current_region"] = aws.get("region") or None
-            aws_detail["last_task"] = {}
+            aws_detail["last_task"] = last_tasks.get(aws.get("configName"), {})
             # add aws_detail.get('configName') to the profile dictionary
             self.profile[aws.get("configName")] = aws_detail
 
@@ -31,10 +46,12 @@ class TaskManager:
             (aws for aws in all_aws if aws.get("configName") == config_name), None
         )
         last_task = self.profile[config_name]["last_task"]
+        queued = self.profile[config_name].get("queued", 0)
         aws_detail = {}
         aws_detail["config_name"] = aws.get("configName")
         aws_detail["current_task"] = None
-        aws_detail["status"] = "idle"
+        aws_detail["status"] = "busy" if queued else "idle"
+        aws_detail["queued"] = queued
         aws_detail["aws_current_region"] = aws.get("region") or None
         aws_detail["last_task"] = last_task
         self.profile[config_name] = aws_detail
@@ -49,39 +66,122 @@ class TaskManager:
             aws_detail["last_task"] = {}
             self.profile[config_name] = aws_detail
 
+    def find_pending(self, config_name, kwargs):
+        # a queued or running task with the same arguments
+        pending = list(self.queues.get(config_name, []))
+        if self.running.get(config_name):
+            pending.append(self.running[config_name])
+        for entry in pending:
+            if entry["kwargs"] == kwargs:
+                return entry
+        return None
+
+    def submit(self, kwargs, exclusive=False):
+        """Queue a task for its profile and return its ticket.
+
+        A request identical to one already queued or running is coalesced
+        into it and gets the same task_id. With exclusive=True nothing new is
+        queued while the profile has other work, and None is returned.
+        """
+        config_name = kwargs.get("config_name")
+        with self.lock:
+            self.register_profile(config_name)
+            queue = self.queues.setdefault(config_name, collections.deque())
+            entry = self.find_pending(config_name, kwargs)
+            if entry is not None:
+                logger.info(
+                    f"[{config_name}] Coalesced {kwargs.get('task_type')} "
+                    + f"into task {entry['task_id']}"
+                )
+                return {"task_id": entry["task_id"], "coalesced": True}
+            if exclusive and (queue or config_name in self.running):
+                return None
+            task_id = self.journal.queue(
+                config_name,
+                kwargs.get("task_type"),
+                datetime.datetime.now().strftime(self.timestamp_format),
+            )
+            queue.append({"task_id": task_id, "kwargs": kwargs})
+            self.profile[config_name]["queued"] = len(queue)
+            if config_name not in self.running:
+                self.running[config_name] = None
+                self.profile[config_name]["status"] = "busy"
+                self.executor.submit(self.drain, config_name)
+        return {"task_id": task_id, "coalesced": False}
+
+    def drain(self, config_name):
+        while True:
+            with self.lock:
+                queue = self.queues[config_name]
+                if not queue:
+                    self.running.pop(config_name, None)
+                    return
+                entry = queue.popleft()
+                self.running[config_name] = entry
+                self.profile[config_name]["queued"] = len(queue)
+            kwargs = entry["kwargs"]
+            try:
+                self.set_start_task(task_id=entry["task_id"], **kwargs)
+            except Exception as e:
+                logger.error(
+                    f"[{config_name}] Task {kwargs.get('task_type')} crashed: {e}"
+                )
+                self.set_stop_task(config_name, "failed", str(e), entry["task_id"])
+            with self.lock:
+                self.running[config_name] = None
+
     def set_start_task(self, **kwargs):
         config_name = kwargs.get("config_name")
         task_type = kwargs.get("task_type")
+        start_time = datetime.datetime.now().strftime(self.timestamp_format)
+        task_id = kwargs.get("task_id")
+        if task_id is None:
+            task_id = self.journal.queue(config_name, task_type, start_time)
+        self.journal.start(task_id, start_time)
         self.profile[config_name]["status"] = "busy"
-        self.profile[config_name]["task_start_time"] = datetime.datetime.now().strftime(
-            self.timestamp_format
-        )
-        self.profile[config_name]["last_task"]["start_time"] = (
-            datetime.datetime.now().strftime(self.timestamp_format)
-        )
+        self.profile[config_name]["task_id"] = task_id
+        self.profile[config_name]["task_start_time"] = start_time
+        self.profile[config_name]["last_task"] = {
+            "task_id": task_id,
+            "task_type": task_type,
+            "start_time": start_time,
+        }
         self.profile[config_name]["current_task"] = task_type
-        self.profile[config_name]["last_task"]["task_type"] = task_type
         task = RunTask()
         task_method = getattr(task, task_type)
         if not task_method:
             return "Task not found"
         result = task_method(**kwargs)
         if result.get("status") == "success":
-            self.set_stop_task(config_name, "success", result)
+            self.set_stop_task(config_name, "success", result, task_id)
         else:
-            self.set_stop_task(config_name, "failed", result)
+            self.set_stop_task(config_name, "failed", result, task_id)
         self.reload_profile(config_name)
         return result
 
-    def set_stop_task(self, config_name, result, data):
-        self.profile[config_name]["status"] = "idle"
+    def set_stop_task(self, config_name, result, data, task_id=None, task_type=None):
+        end_time = datetime.datetime.now().strftime(self.timestamp_format)
+        if task_id is None:
+            # rejected before it ran (e.g. login failed), keep the running task
+            self.journal.record(config_name, task_type, result, data, end_time)
+            if config_name in self.running:
+                return
+        else:
+            self.journal.finish(task_id, result, data, end_time)
+            self.profile[config_name]["task_id"] = None
+        queued = self.profile[config_name].get("queued", 0)
+        self.profile[config_name]["status"] = "busy" if queued else "idle"
         self.profile[config_name]["current_task"] = None
-        self.profile[config_name]["last_task"]["end_time"] = (
-            datetime.datetime.now().strftime(self.timestamp_format)
-        )
+        self.profile[config_name]["last_task"]["end_time"] = end_time
         self.profile[config_name]["last_task"]["status"] = result
         self.profile[config_name]["last_task"]["data"] = data
 
+    def get_history(self, **kwargs):
+        return self.journal.history(**kwargs)
+
+    def get_task(self, task_id):
+        return self.journal.get(task_id)
+
     def execute_task(self, **kwargs):
         task_type = kwargs.get("task_type")
         kwargs.pop("task_type")